@@ -1,6 +1,7 @@
 import socket
 import os
 from shared.encryption import Encryption
+from shared.framing import Framing
 
 class Client:
     """
@@ -12,36 +13,48 @@ class Client:
         port (int): The server port number.
         socket (socket.socket): The client socket for communication.
         public_key (str): The public key used for encrypting messages.
+        private_key (str): The private key used for decrypting the server responses.
         client_id (str or None): The ID assigned to the client upon registration.
         username (str or None): The username of the client.
+        backend: The object that loads the keys and encrypts and decrypts the messages.
     """
     
-    def __init__(self, host='localhost', port=5000):
+    def __init__(self, host='localhost', port=5000, backend=None):
         """
         Initializes the client with the given server host and port, and sets up the socket connection.
-        Loads the public key for encryption.
+        Nagle's algorithm is disabled on the socket, since every command is a small message
+        that waits for its response and would otherwise be held back until the previous one is acknowledged.
+        Loads the public key for encryption and the private key for decryption once,
+        so receiving a message does not read and parse a key file.
         
         Args:
             host (str): The server's host address (default is 'localhost').
             port (int): The server's port number (default is 5000).
+            backend (optional): An object with the 'load_key', 'encrypt_message' and
+                'decrypt_message' methods of Encryption, used instead of it (defaults to
+                Encryption). Tests can pass a backend that does no cryptography at all.
         """
         self.host = host
         self.port = port
+        self.backend = backend or Encryption
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.socket.connect((self.host, self.port))
-        self.public_key = Encryption.load_key('server_public_key.pem')
+        self.public_key = self.backend.load_key('server_public_key.der')
+        self.private_key = self.backend.load_key('server_private_key.der')
         self.client_id = None
         self.username = None
+        self._rxbuf = bytearray(65536)
 
     def send_message(self, message):
         """
-        Encrypts and sends a message to the server.
+        Encrypts and sends a message to the server as a length-prefixed message.
         
         Args:
             message (str): The message to send to the server.
         """
-        encrypted_message = Encryption.encrypt_message(self.public_key, message)
-        self.socket.send(encrypted_message)
+        encrypted_message = self.backend.encrypt_message(self.public_key, message)
+        Framing.send_frame(self.socket, encrypted_message)
 
     def receive_message(self):
         """
@@ -49,9 +62,14 @@ class Client:
         
         Returns:
             str: The decrypted message from the server.
+
+        Raises:
+            ConnectionError: If the server closed the connection.
         """
-        encrypted_message = self.socket.recv(1024)
-        return Encryption.decrypt_message(Encryption.load_key('server_private_key.pem'), encrypted_message)
+        encrypted_message = Framing.recv_frame(self.socket, self._rxbuf)
+        if encrypted_message is None:
+            raise ConnectionError('Connection closed by the server')
+        return self.backend.decrypt_message(self.private_key, encrypted_message)
 
     def register(self, username):
         """
@@ -104,13 +122,21 @@ class Client:
         response = self.receive_message()
         print(f'Server Response: Verify Response: {response}\n')
 
+    def repair(self):
+        """
+        Asks the server to repair the invalid blocks of the blockchain.
+        """
+        self.send_message('repair')
+        response = self.receive_message()
+        print(f'Server Response: Repair Response: {response}\n')
+
     def interactive_mode(self):
         """
         Starts an interactive command-line interface for the client to interact with the server.
-        Allows users to register, add transactions, copy data, verify, and exit.
+        Allows users to register, add transactions, copy data, verify, repair, and exit.
         """
         while True:
-            print("Client Commands: 'register <username>', 'add <username> <action> <stock>', 'copy [<username>]', 'verify', 'exit'")
+            print("Client Commands: 'register <username>', 'add <username> <action> <stock>', 'copy [<username>]', 'verify', 'repair', 'exit'")
             command = input("Enter command: ")
             
             if command == 'exit':
@@ -139,6 +165,8 @@ class Client:
                     print("Invalid 'copy' command. Usage: copy [<username>]\n")
             elif command.startswith('verify'):
                 self.verify()
+            elif command.startswith('repair'):
+                self.repair()
             else:
                 print("Unknown command. Try again.\n")
 
@@ -2,28 +2,127 @@ import hashlib
 import time
 import json
 import os
+import mmap
+import itertools
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timezone
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+OPERATION_CODES = {'buy': 0, 'sell': 1}
+VALID_OPERATION_CODES = bytes(OPERATION_CODES.values())
+INVALID_OPERATION_CODE = 255
+
+CHAIN_LOG = 'chain.log'
+CHAIN_LOG_JSON = 'chain.jsonl'
+
+# A proof is valid when the hex digest starts with "0000", i.e. the first two digest bytes are zero.
+PROOF_PREFIX = b'\x00\x00'
+
+_stop_event = None
+
+def find_proof(last_proof):
+    """
+    Finds the smallest proof whose hash together with the previous proof starts with "0000".
+    Module-level so that it can be sent to a worker process.
+
+    Args:
+        last_proof (int): The proof of the previous block.
+
+    Returns:
+        int: The proof that solves the problem.
+    """
+    # Same check as Blockchain.valid_proof, inlined to avoid a method call per candidate.
+    # hashlib.sha256 is backed by OpenSSL, which already uses the CPU's SHA extensions.
+    # The previous proof is the same for every candidate: it is absorbed once into a base
+    # context, which is copied so that only the candidate proof is hashed per iteration.
+    new_context = hashlib.sha256(str(last_proof).encode()).copy
+    proof = 0
+    while True:
+        context = new_context()
+        context.update(b'%d' % proof)
+        if context.digest()[:2] == PROOF_PREFIX:
+            return proof
+        proof += 1
+
+def _init_proof_worker(stop_event):
+    """
+    Initializes a proof-of-work worker process with the event shared by all workers.
+
+    Args:
+        stop_event (multiprocessing.Event): Event set by the first worker that finds a proof.
+    """
+    global _stop_event
+    _stop_event = stop_event
+
+def _find_proof_strided(last_proof, start, stride, batch_size=1024):
+    """
+    Searches the proofs start, start + stride, start + 2 * stride, ... until one is valid
+    or another worker signals that it has found a proof.
+
+    Args:
+        last_proof (int): The proof of the previous block.
+        start (int): The first proof to try.
+        stride (int): The distance between two consecutive proofs tried by this worker.
+        batch_size (int): Number of proofs tried between two checks of the stop event.
+
+    Returns:
+        int or None: The proof found, or None if another worker found one first.
+    """
+    new_context = hashlib.sha256(str(last_proof).encode()).copy
+    proof = start
+    while not _stop_event.is_set():
+        for _ in range(batch_size):
+            context = new_context()
+            context.update(b'%d' % proof)
+            if context.digest()[:2] == PROOF_PREFIX:
+                _stop_event.set()
+                return proof
+            proof += stride
+    return None
+
 class Blockchain:
     """
     Class to represent a blockchain. This class manages the creation of blocks,
     the addition of transactions, the hashing of blocks, the verification of the chain integrity
-    and the storage of blocks as JSON files.
+    and the storage of blocks in an append-only log.
+
+    Keys starting with an underscore (such as '_canon') hold in-memory caches: they are
+    neither hashed nor saved to disk.
 
     Attributes:
     chain (list): List of blocks that make up the blockchain.
-    current_transactions (list): List of transactions that are waiting to be added to a block.
-    blockchain_dir (str): Directory where the JSON files of the blocks are saved.
+    current_transactions (collections.deque): Transactions that are waiting to be added to a block.
+        Appending and draining it are atomic, so transactions can be added while a block is created.
+    tx_index (dict): Positions (block index, transaction offset) of the transactions in the chain, by user id.
+    blockchain_dir (str): Directory where the chain log of the blocks is saved.
     """
     
-    def __init__(self):
+    def __init__(self, blockchain_dir=None):
         """
-        Initializes the blockchain and loads blocks from existing JSON files.
+        Initializes the blockchain and loads blocks from existing block files.
         If the chain is empty, creates the genesis block.
+
+        Args:
+            blockchain_dir (str, optional): Directory where the blocks are saved
+                (defaults to the 'blockchain_data' folder next to this module).
         """
         self.chain = []
-        self.current_transactions = []
-        self.blockchain_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blockchain_data')
+        self.current_transactions = collections.deque()
+        self._last_valid_index = 0
+        self.tx_index = collections.defaultdict(list)
+        self._log = None
+        self.blockchain_dir = blockchain_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blockchain_data')
         
         if not os.path.exists(self.blockchain_dir):
             os.makedirs(self.blockchain_dir)
@@ -47,6 +146,7 @@ class Blockchain:
             'previous_hash': '0',  
             'proof': 100  
         }
+        genesis_block['_canon'] = self.serialize(genesis_block)
         genesis_block['hash'] = self.hash(genesis_block)
         self.chain.append(genesis_block)
         self.save_block_to_json(genesis_block)
@@ -66,43 +166,99 @@ class Blockchain:
             raise ValueError("Cannot create a block on an invalid blockchain.")
         
         last_block = self.last_block
-        calculated_previous_hash = self.hash(last_block) if last_block else '0'
-        previous_hash = previous_hash or calculated_previous_hash
+        if previous_hash is None:
+            previous_hash = (last_block.get('hash') or self.hash(last_block)) if last_block else '0'
 
         timestamp = time.time()
         formatted_timestamp = datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
 
+        # Drain the pending transactions one by one instead of replacing the deque, so that a
+        # transaction added concurrently is either in this block or left for the next one.
+        transactions = []
+        while self.current_transactions:
+            transactions.append(self.current_transactions.popleft())
+
         block = {
             'index': len(self.chain),
             'timestamp': formatted_timestamp,  
-            'data': self.current_transactions,
+            'data': transactions,
             'previous_hash': previous_hash,
             'proof': proof
         }
+        block['_canon'] = self.serialize(block)
         block['hash'] = self.hash(block)
 
         self.save_block_to_json(block)
-        self.current_transactions = []
         self.chain.append(block)
+        self.index_block(block)
         return block
 
+    def index_block(self, block):
+        """
+        Adds the transactions of a block of the chain to the index of transactions by user id.
+
+        Args:
+            block (dict): The block to index.
+        """
+        if not isinstance(block['data'], list):
+            return
+        for offset, transaction in enumerate(block['data']):
+            if isinstance(transaction, dict) and 'user_id' in transaction:
+                self.tx_index[transaction['user_id']].append((block['index'], offset))
+
     def save_block_to_json(self, block):
         """
-        Saves a block as a JSON file in the 'blockchain_data' folder.
+        Appends a block to the chain log in the 'blockchain_data' folder. The log holds one
+        msgpack record per block ('chain.log') when msgpack is installed, and one line of JSON
+        per block ('chain.jsonl') otherwise. Saving a block again appends a new record:
+        when the log is loaded, the last record of each index wins.
 
         Args:
             block (dict): The block to save.
         """
-        block_filename = f"block_{block['index']}.json"
-        file_path = os.path.join(self.blockchain_dir, block_filename)
+        stored_block = {key: value for key, value in block.items() if not key.startswith('_')}
+
+        if msgpack is not None:
+            data = msgpack.packb(stored_block, use_bin_type=True)
+        elif orjson is not None:
+            data = orjson.dumps(stored_block) + b'\n'
+        else:
+            data = json.dumps(stored_block).encode() + b'\n'
 
         try:
-            with open(file_path, 'w') as f:
-                json.dump(block, f, indent=4)
+            log = self.open_chain_log()
+            view = memoryview(data)
+            while view:
+                view = view[log.write(view):]
             
         except Exception as e:
             print(f"Error saving block {block['index']}: {e}")
 
+    def open_chain_log(self):
+        """
+        Returns the chain log of 'blockchain_dir', opened unbuffered for appending so that each
+        block is written with a single system call. The file stays open between blocks and is
+        reopened if 'blockchain_dir' changes.
+
+        Returns:
+            io.FileIO: The open chain log.
+        """
+        log_name = CHAIN_LOG if msgpack is not None else CHAIN_LOG_JSON
+        log_path = os.path.join(self.blockchain_dir, log_name)
+
+        if self._log is None or self._log.name != log_path:
+            if self._log is not None:
+                self._log.close()
+            self._log = open(log_path, 'ab', buffering=0)
+        return self._log
+
+    def close(self):
+        """
+        Closes the chain log if it is open. It is opened again by the next block saved.
+        """
+        if self._log is not None:
+            self._log.close()
+            self._log = None
 
     def add_transaction(self, transaction):
         """
@@ -138,9 +294,74 @@ class Blockchain:
         
         return True
     
+    def serialize(self, block):
+        """
+        Returns the canonical serialization of a block, the bytes that are hashed.
+        The 'hash' key and in-memory keys starting with an underscore are excluded.
+
+        Args:
+            block (dict): The block to serialize.
+
+        Returns:
+            bytes: The block as sorted-key JSON encoded in UTF-8.
+        """
+        # Only copy the block when it holds keys to exclude: blocks being created are serialized
+        # before their hash is added, and blocks being loaded have their hash popped first.
+        if 'hash' in block or any(key.startswith('_') for key in block):
+            block = {key: value for key, value in block.items() if key != 'hash' and not key.startswith('_')}
+        return json.dumps(block, sort_keys=True).encode()
+
+    def columns(self, block):
+        """
+        Returns the transactions of a block as parallel columns, one entry per transaction.
+        The operation types are packed into a bytes object of operation codes, so a whole
+        block can be checked with a single C-level scan. The result is cached in block['_columns'].
+
+        Args:
+            block (dict): The block whose transactions are returned.
+
+        Returns:
+            dict: 'user_ids' (tuple), 'ops' (bytes of OPERATION_CODES values, INVALID_OPERATION_CODE
+            for unknown operations) and 'stocks' (tuple).
+        """
+        columns = block.get('_columns')
+        if columns is None:
+            transactions = [t if isinstance(t, dict) else {} for t in block['data']] if isinstance(block['data'], list) else []
+            columns = {
+                'user_ids': tuple(t.get('user_id') for t in transactions),
+                'ops': bytes(OPERATION_CODES.get(t.get('operation_type'), INVALID_OPERATION_CODE) for t in transactions),
+                'stocks': tuple(t.get('stock_name') for t in transactions)
+            }
+            block['_columns'] = columns
+        return columns
+
+    def has_valid_transactions(self, block):
+        """
+        Validates all the transactions of a block at once, using its columns.
+        Equivalent to calling is_valid_transaction on each transaction.
+        The result is cached in block['_valid'], so a block is only validated once.
+
+        Args:
+            block (dict): The block to validate.
+
+        Returns:
+            bool: True if every transaction of the block is valid, False otherwise.
+        """
+        valid = block.get('_valid')
+        if valid is None:
+            if not isinstance(block['data'], list):
+                valid = False
+            else:
+                columns = self.columns(block)
+                valid = not columns['ops'].translate(None, VALID_OPERATION_CODES) and all(columns['stocks'])
+            block['_valid'] = valid
+        return valid
+
     def hash(self, block):
         """
         Returns the hash of a block.
+        Uses the serialization cached in block['_canon'] when present, so a block
+        is only serialized once no matter how many times it is hashed.
 
         Args:
             block (dict): The block to hash.
@@ -148,9 +369,9 @@ class Blockchain:
         Returns:
             str: The hash of the block.
         """
-        block_copy = block.copy()
-        block_copy.pop('hash', None)  
-        block_string = json.dumps(block_copy, sort_keys=True).encode()
+        block_string = block.get('_canon')
+        if block_string is None:
+            block_string = self.serialize(block)
         return hashlib.sha256(block_string).hexdigest()
 
     def proof_of_work(self, last_proof):
@@ -163,10 +384,29 @@ class Blockchain:
         Returns:
             int: The proof that solves the problem.
         """
-        proof = 0
-        while not self.valid_proof(last_proof, proof):
-            proof += 1
-        return proof
+        return find_proof(last_proof)
+
+    def proof_of_work_parallel(self, last_proof, workers=None):
+        """
+        Performs the proof-of-work process using several processes. Each worker searches
+        a disjoint set of proofs (proof % workers == k) and the first valid proof found wins.
+
+        Args:
+            last_proof (int): The proof of the previous block.
+            workers (int, optional): Number of worker processes (defaults to the number of CPUs).
+
+        Returns:
+            int: A proof that solves the problem (not necessarily the smallest one).
+        """
+        workers = workers or os.cpu_count() or 1
+        stop_event = multiprocessing.Event()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_proof_worker, initargs=(stop_event,)) as executor:
+            futures = [executor.submit(_find_proof_strided, last_proof, k, workers) for k in range(workers)]
+            for future in as_completed(futures):
+                proof = future.result()
+                if proof is not None:
+                    return proof
 
     def valid_proof(self, last_proof, proof):
         """
@@ -180,71 +420,194 @@ class Blockchain:
             bool: True if the proof is valid, False otherwise.
         """
         guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        return hashlib.sha256(guess).digest()[:2] == PROOF_PREFIX
 
     def is_valid_chain(self):
         """
         Checks the integrity of the blockchain.
+        Only the blocks appended since the last successful check are validated,
+        so repeated calls cost O(new blocks) instead of O(chain length).
 
         Returns:
             bool: True if the chain is valid, False if it has integrity issues.
         """
-        for i in range(1, len(self.chain)):
+        if self._last_valid_index >= len(self.chain):
+            self._last_valid_index = 0
+
+        for i in range(self._last_valid_index + 1, len(self.chain)):
             current_block = self.chain[i]
             previous_block = self.chain[i - 1]
             
             if current_block['previous_hash'] != previous_block['hash']:
                 return False
             
-            for transaction in current_block['data']:
-                if not self.is_valid_transaction(transaction):
-                    return False
+            if not self.has_valid_transactions(current_block):
+                return False
+
+            self._last_valid_index = i
         return True
 
-    def verify_integrity(self):
+    def verify(self):
         """
-        Checks the integrity of all blocks in the chain.
-        If any block has an incorrect hash, it recalculates it and saves it again.
+        Checks every block of the chain without modifying it or the files on disk.
+        A block is invalid if its stored hash does not match its contents, or if its
+        'previous_hash' does not match the hash of the block before it. The hashes are
+        recalculated from the current contents of the blocks, not from the serialization
+        cached in '_canon', so blocks altered in memory are detected too.
 
         Returns:
-            bool: True if the integrity is valid, False otherwise.
+            tuple: (bool, list) True if the chain is valid, and the indices of the invalid blocks.
         """
-        current_block = self.chain[0]  
-        block_index = 1
+        bad_indices = []
+        previous_hash = None
 
-        while block_index < len(self.chain):
-            block = self.chain[block_index]
-            recalculated_previous_hash = self.hash(current_block)
+        for i, block in enumerate(self.chain):
+            block_hash = hashlib.sha256(self.serialize(block)).hexdigest()
+            if block['hash'] != block_hash or (i > 0 and block['previous_hash'] != previous_hash):
+                bad_indices.append(i)
+            previous_hash = block_hash
 
-            if block['previous_hash'] != recalculated_previous_hash:
-                print(f"Error: Recalculating block {block['index']}.")
-                block['previous_hash'] = recalculated_previous_hash  
+        return not bad_indices, bad_indices
 
-                block['hash'] = self.hash(block)
-                
-                self.chain[block_index] = block  
+    def repair(self):
+        """
+        Recalculates the 'previous_hash' and hash of the blocks from the first invalid one
+        onwards, and saves the blocks that changed to disk. A block whose transactions are
+        not valid is never hashed again, so an altered transaction cannot be made to look
+        valid: the repair stops at that block and leaves it and the blocks after it invalid.
 
+        Returns:
+            list: The indices of the blocks whose 'previous_hash' or hash was rewritten.
+        """
+        _, bad_indices = self.verify()
+        if not bad_indices:
+            return bad_indices
+
+        repaired_indices = []
+        for i in range(bad_indices[0], len(self.chain)):
+            block = self.chain[i]
+            block.pop('_columns', None)
+            block.pop('_valid', None)
+            if i > 0 and not self.has_valid_transactions(block):
+                print(f"Error: Block {block['index']} has invalid transactions and cannot be repaired.")
+                break
+            old_previous_hash = block['previous_hash']
+            if i > 0:
+                block['previous_hash'] = self.chain[i - 1]['hash']
+            block['_canon'] = self.serialize(block)
+            block_hash = self.hash(block)
+            if block['hash'] != block_hash or block['previous_hash'] != old_previous_hash:
+                print(f"Error: Recalculating block {block['index']}.")
+                block['hash'] = block_hash
                 self.save_block_to_json(block)
+                repaired_indices.append(i)
 
-            current_block = block
-            block_index += 1
+        self._last_valid_index = min(self._last_valid_index, max(bad_indices[0] - 1, 0))
+        return repaired_indices
 
-        return True
+    def verify_integrity(self):
+        """
+        Checks the integrity of all blocks in the chain. Use 'repair' to fix an invalid chain.
+
+        Returns:
+            bool: True if the integrity is valid, False otherwise.
+        """
+        is_valid, _ = self.verify()
+        return is_valid
 
     def load_chain_from_json(self):
         """
-        Loads blocks from JSON files and verifies their integrity.
-        If the hashes do not match, updates the block with the recalculated hash.
+        Loads the blocks saved in the 'blockchain_data' folder: first the legacy files with one
+        block each ('block_<index>.json' or '.mpk'), in index order, then the records of the chain
+        logs. A record for an index that is already loaded replaces that block.
+        The chain is validated again from the start, and the index of transactions is rebuilt.
         """
+        self._last_valid_index = 0
+        self.tx_index.clear()
+
+        saved_blocks = ()
         if os.path.exists(self.blockchain_dir):
-            for filename in sorted(os.listdir(self.blockchain_dir)):
-                if filename.endswith('.json'):
-                    file_path = os.path.join(self.blockchain_dir, filename)
-                    with open(file_path, 'r') as f:
-                        block = json.load(f)
-                        
-                        self.chain.append(block)
+            saved_blocks = itertools.chain(self.read_block_files(), self.read_chain_logs())
+
+        for block in saved_blocks:
+            # The block was just decoded and is not shared yet: pop its hash instead of copying it.
+            stored_hash = block.pop('hash', None)
+            block['_canon'] = self.serialize(block)
+            block['hash'] = stored_hash
+            
+            if block['index'] < len(self.chain):
+                self.chain[block['index']] = block
+            else:
+                self.chain.append(block)
+
+        for block in self.chain:
+            self.index_block(block)
+
+    def read_block_files(self):
+        """
+        Reads the legacy files holding one block each, sorted by block index (so that
+        'block_10' comes after 'block_2'). When a block exists in both formats, the msgpack
+        file is the most recent one.
+
+        Yields:
+            dict: The blocks, in index order.
+        """
+        block_files = {}
+        for filename in os.listdir(self.blockchain_dir):
+            name, extension = os.path.splitext(filename)
+            if name.startswith('block_') and name[6:].isdigit() and extension in ('.json', '.mpk'):
+                if extension == '.mpk' or name not in block_files:
+                    block_files[name] = filename
+
+        for name in sorted(block_files, key=lambda name: int(name[6:])):
+            filename = block_files[name]
+            with open(os.path.join(self.blockchain_dir, filename), 'rb') as f:
+                data = f.read()
+
+            if filename.endswith('.mpk'):
+                if msgpack is None:
+                    raise RuntimeError(f"msgpack is required to load {filename}")
+                yield msgpack.unpackb(data, raw=False)
+            else:
+                yield orjson.loads(data) if orjson is not None else json.loads(data)
+
+    def read_chain_logs(self):
+        """
+        Reads the records of the chain logs. Each log is memory-mapped and parsed in a single
+        pass. The JSON log is read before the msgpack one, which is used once msgpack is installed.
+        A last record cut short by an interrupted write is ignored, and the log is truncated
+        after the last complete record so that the next block is not appended to it.
+
+        Yields:
+            dict: The blocks, in the order they were saved.
+        """
+        for log_name in (CHAIN_LOG_JSON, CHAIN_LOG):
+            log_path = os.path.join(self.blockchain_dir, log_name)
+            log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+            if log_size == 0:
+                continue
+            if log_name == CHAIN_LOG and msgpack is None:
+                raise RuntimeError(f"msgpack is required to load {log_name}")
+
+            with open(log_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if log_name == CHAIN_LOG:
+                    unpacker = msgpack.Unpacker(raw=False)
+                    unpacker.feed(mm)
+                    complete_size = 0
+                    for block in unpacker:
+                        # Read the offset after each block: once a record is cut short, tell()
+                        # also counts the part of it that was parsed.
+                        complete_size = unpacker.tell()
+                        yield block
+                else:
+                    complete_size = mm.rfind(b'\n') + 1
+                    for line in iter(mm.readline, b''):
+                        if line.endswith(b'\n'):
+                            yield orjson.loads(line) if orjson is not None else json.loads(line)
+
+            if complete_size < log_size:
+                print(f"Warning: Discarding an incomplete record at the end of {log_name}.")
+                os.truncate(log_path, complete_size)
     
     @property
     def last_block(self):
@@ -1,9 +1,18 @@
 import os
 import json
 import socket
+import asyncio
 import threading
-from server.blockchain import Blockchain
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from server.blockchain import Blockchain, find_proof
 from shared.encryption import Encryption
+from shared.framing import HEADER, MAX_FRAME_SIZE
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 class Server:
     """
@@ -22,33 +31,59 @@ class Server:
         users_data_path (str): Directory where user data is stored.
         users_file (str): Path to the JSON file containing registered users.
         users (dict): Dictionary containing users and their ids.
+        pow_executor (ProcessPoolExecutor or None): Process pool running the proof of work
+            while the server is started, so mining does not hold up other connections.
+        max_workers (int): Maximum number of commands processed at the same time.
+        batch_size (int): Number of pending transactions that triggers mining a block.
+        batch_delay (float): Maximum number of seconds a transaction waits before its block is mined.
     """
     
-    def __init__(self, host='localhost', port=5000):
+    def __init__(self, host='localhost', port=5000, max_workers=None, batch_size=8, batch_delay=0.5,
+                 blockchain_dir=None, users_file=None):
         """
         Initializes the server, configures the socket, loads the blockchain and user data.
 
         Args:
             host (str): Host address (default 'localhost').
             port (int): Port where the server will listen for connections (default 5000).
+            max_workers (int, optional): Maximum number of commands processed at the same time
+                (defaults to four per CPU, at most 32).
+            batch_size (int): Number of pending transactions that triggers mining a block (default 8).
+            batch_delay (float): Maximum number of seconds a transaction waits before its block
+                is mined (default 0.5).
+            blockchain_dir (str, optional): Directory where the blocks are saved (defaults to
+                'server/blockchain_data').
+            users_file (str, optional): Path of the JSON file of registered users (defaults to
+                'server/users_data/users.json').
         """
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
-        self.blockchain = Blockchain()
-        self.private_key = Encryption.load_key('server_private_key.pem')
+        self.blockchain = Blockchain(blockchain_dir)
+        self.private_key = Encryption.load_key('server_private_key.der')
 
         self.base_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server'))
         
-        self.users_data_path = os.path.join(self.base_path, 'users_data')
+        if users_file is None:
+            users_file = os.path.join(self.base_path, 'users_data', 'users.json')
+        self.users_data_path = os.path.dirname(os.path.abspath(users_file))
         
         if not os.path.exists(self.users_data_path):
             os.makedirs(self.users_data_path)
         
-        self.users_file = os.path.join(self.users_data_path, 'users.json')
+        self.users_file = users_file
         self.users = self.load_users()
+        self.pow_executor = None
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) * 4)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='server-worker')
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._chain_lock = threading.Lock()
+        self._timer_lock = threading.Lock()
+        self._flush_timer = None
 
     def load_users(self):
         """
@@ -70,43 +105,94 @@ class Server:
         with open(self.users_file, 'w') as file:
             json.dump(self.users, file, indent=4)
 
-    def handle_client(self, client_socket):
+    def encrypt_response(self, response, session_key=None):
         """
-        Handles communication with a client. Receives commands from the client, processes them, and sends responses.
+        Encrypts a response for the client. Every response is encrypted with a new nonce (and,
+        without a session, a new AES key), so no two clients or messages get the same ciphertext,
+        even for constant responses.
 
         Args:
-            client_socket (socket.socket): The client connection socket.
+            response (str): The response to encrypt.
+            session_key (bytes, optional): The session key of the connection, if the client
+                opened a session. The response is then encrypted with it alone.
+
+        Returns:
+            bytes: The encrypted response.
         """
-        while True:
-            encrypted_message = client_socket.recv(1024)
-            if not encrypted_message:
-                break
+        if session_key is not None:
+            return Encryption.encrypt_session_message(session_key, response)
+        return Encryption.encrypt_message(self.private_key, response)
+
+    def handle_message(self, encrypted_message, session_key=None):
+        """
+        Decrypts a command received from a client, processes it and returns the encrypted response.
+
+        Args:
+            encrypted_message (bytes): The encrypted command.
+            session_key (bytes, optional): The session key of the connection, if the client
+                opened a session.
+
+        Returns:
+            bytes: The encrypted response.
+        """
+        if session_key is not None:
+            message = Encryption.decrypt_session_message(session_key, encrypted_message)
+        else:
             message = Encryption.decrypt_message(self.private_key, encrypted_message)
-            print(f'Received: {message}')
-            command_parts = message.split(' ')
-
-            if command_parts[0] == 'register':
-                self.handle_register(command_parts[1], client_socket)
-            
-            elif command_parts[0] == 'add':
-                self.handle_add_transaction(command_parts[1:], client_socket)
-            
-            elif command_parts[0] == 'copy':
-                self.handle_copy_transactions(command_parts, client_socket)
-            
-            elif command_parts[0] == 'verify':
-                self.handle_verify_integrity(client_socket)
-            
-            else:
-                client_socket.send(Encryption.encrypt_message(self.private_key, 'Unknown command'))
+        print(f'Received: {message}')
+        command_parts = message.split(' ')
+
+        if command_parts[0] == 'register':
+            response = self.handle_register(command_parts[1])
+        
+        elif command_parts[0] == 'add':
+            response = self.handle_add_transaction(command_parts[1:])
+        
+        elif command_parts[0] == 'copy':
+            response = self.handle_copy_transactions(command_parts)
+        
+        elif command_parts[0] == 'verify':
+            response = self.handle_verify_integrity()
+
+        elif command_parts[0] == 'repair':
+            response = self.handle_repair_chain()
+        
+        else:
+            response = 'Unknown command'
+
+        return self.encrypt_response(response, session_key)
 
-    def handle_register(self, username, client_socket):
+    def handle_frame(self, frame, session_key=None):
+        """
+        Handles one message received on a connection. Until a session is opened, a message
+        that is exactly the size of an RSA block is a session key encrypted by
+        'Encryption.establish_session' (a command is always longer, since it also carries
+        a nonce and a tag): the session is opened and confirmed, and the following commands
+        of the connection are encrypted with the session key alone. Any other message is
+        a command.
+
+        Args:
+            frame (bytes): The message received.
+            session_key (bytes, optional): The session key of the connection, if one is open.
+
+        Returns:
+            tuple: The session key of the connection (None if no session is open) and the
+            encrypted response.
+        """
+        if session_key is None and len(frame) == self.private_key.size_in_bytes():
+            session_key = Encryption.open_session(self.private_key, frame)
+            return session_key, self.encrypt_response('Session established', session_key)
+        return session_key, self.handle_message(frame, session_key)
+
+    def handle_register(self, username):
         """
         Handles the registration of a new user.
 
         Args:
             username (str): The username attempting to register.
-            client_socket (socket.socket): The client connection socket.
+
+        Returns:
+            str: The response for the client.
         """
         if username in self.users:
             response = 'Username already taken'
@@ -116,20 +202,39 @@ class Server:
             self.save_users()
             response = f'Registered with ID: {client_id}'
         
-        client_socket.send(Encryption.encrypt_message(self.private_key, response))
+        return response
 
-    def handle_add_transaction(self, command_parts, client_socket):
+    def find_proof(self, last_proof):
+        """
+        Runs the proof of work, in the worker process pool when the server is started.
+
+        Args:
+            last_proof (int): The proof of the previous block.
+
+        Returns:
+            int: The proof that solves the problem.
+        """
+        if self.pow_executor is None:
+            return self.blockchain.proof_of_work(last_proof)
+        return self.pow_executor.submit(find_proof, last_proof).result()
+
+    def handle_add_transaction(self, command_parts):
         """
         Handles adding a new transaction to the blockchain.
+        'Transaction added' means that the transaction is queued: it is mined into a block
+        once 'batch_size' transactions are pending, or 'batch_delay' seconds later, and until
+        then 'copy' and 'verify' do not see it.
 
         Args:
             command_parts (list): The list of command parts containing the username,
             operation type, and action name of the transaction.
-            client_socket (socket.socket): The client connection socket.
+
+        Returns:
+            str: The response for the client.
         """
         username = command_parts[0]
         if username not in self.users:
-            client_socket.send(Encryption.encrypt_message(self.private_key, 'Username not registered'))
+            return 'Username not registered'
         else:
             client_id = self.users[username]
             transaction = {
@@ -140,136 +245,290 @@ class Server:
 
             if not self.blockchain.is_valid_transaction(transaction):
                 response = 'Invalid transaction. Ensure operation type is "buy" or "sell".'
-                client_socket.send(Encryption.encrypt_message(self.private_key, response))
-                return
+                return response
         
             self.blockchain.add_transaction(transaction)
             print(f"Transaction added: {transaction}")
-            
-            last_block = self.blockchain.last_block
-            proof = self.blockchain.proof_of_work(last_block['proof'])
-            previous_hash = self.blockchain.hash(last_block)
-            
-            self.blockchain.create_block(proof, previous_hash)
-            print(f"Block created")
-            client_socket.send(Encryption.encrypt_message(self.private_key, 'Transaction added'))
 
-    def handle_copy_transactions(self, command_parts, client_socket):
+            if len(self.blockchain.current_transactions) >= self.batch_size:
+                self.flush_mempool()
+            else:
+                with self._timer_lock:
+                    if self._flush_timer is None:
+                        self._flush_timer = threading.Timer(self.batch_delay, self.flush_mempool)
+                        self._flush_timer.daemon = True
+                        self._flush_timer.start()
+            return 'Transaction added'
+
+    def mine_pending_transactions(self):
         """
-        Handles copying transactions for a specific user or for all users.
+        Mines a block with the pending transactions, if there are any.
+        The caller must hold the chain lock.
+
+        Returns:
+            dict or None: The new block, or None if there were no pending transactions.
+        """
+        with self._timer_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+        if not self.blockchain.current_transactions:
+            return None
+
+        last_block = self.blockchain.last_block
+        proof = self.find_proof(last_block['proof'])
+
+        block = self.blockchain.create_block(proof)
+        print(f"Block created")
+        return block
+
+    def flush_mempool(self):
+        """
+        Mines a block with the pending transactions. Transactions are mined in batches of
+        'batch_size', and this runs 'batch_delay' seconds after the first transaction of an
+        incomplete batch, so no transaction waits indefinitely.
+
+        Returns:
+            dict or None: The new block, or None if there were no pending transactions.
+        """
+        with self._chain_lock:
+            return self.mine_pending_transactions()
+
+    def handle_copy_transactions(self, command_parts):
+        """
+        Handles copying transactions for a specific user or for all users. Only the transactions
+        already mined are copied; the chain is read under the chain lock, so a block being
+        mined at the same time is either copied whole or not at all.
 
         Args:
             command_parts (list): The list of command parts, which may contain the user name.
-            client_socket (socket.socket): The client connection socket.
+
+        Returns:
+            str: The response for the client.
         """
         if len(command_parts) == 2:
-            self.copy_user_transactions(command_parts[1], client_socket)
+            with self._chain_lock:
+                return self.copy_user_transactions(command_parts[1])
         elif len(command_parts) == 1:
-            self.copy_all_transactions(client_socket)
+            with self._chain_lock:
+                return self.copy_all_transactions()
         else:
             response = 'Invalid copy command. Usage: copy [<username>]'
-            client_socket.send(Encryption.encrypt_message(self.private_key, response))
+            return response
 
-    def copy_user_transactions(self, username, client_socket):
+    def copy_user_transactions(self, username):
         """
         Copies the transactions of a specific user to a JSON file.
 
         Args:
             username (str): The username whose transactions will be copied.
-            client_socket (socket.socket): The client connection socket.
+
+        Returns:
+            str: The response for the client.
         """
         if username not in self.users:
-            client_socket.send(Encryption.encrypt_message(self.private_key, 'Username not registered'))
+            return 'Username not registered'
         else:
             client_id = self.users[username]
-            user_transactions = []
-
-            for block in self.blockchain.chain:
-                if isinstance(block['data'], list):  
-                    for transaction in block['data']:
-                        if isinstance(transaction, dict) and transaction.get('user_id') == client_id:
-                            transaction_info = {
-                                'transaction': transaction,
-                                'block_info': {
-                                    'timestamp': block['timestamp'],
-                                    'previous_hash': block['previous_hash'],
-                                    'proof': block['proof'],
-                                    'hash': block['hash']
-                                }
-                            }
-                            user_transactions.append(transaction_info)
-
-            if user_transactions:
-                file_path = f"transactions_{username}.json"
-                with open(file_path, 'w') as file:
-                    json.dump(user_transactions, file, indent=4)
+            file_path = f"transactions_{username}.json"
 
+            if self.write_transactions(file_path, self.user_transactions(client_id)):
                 response = f'Transactions copied for user {username} and saved to {file_path}'
             else:
                 response = 'No transactions found for this user.'
         
-            client_socket.send(Encryption.encrypt_message(self.private_key, response))
+            return response
 
-    def copy_all_transactions(self, client_socket):
+    def copy_all_transactions(self):
         """
         Copies all transactions from the blockchain to a JSON file.
 
+        Returns:
+            str: The response for the client.
+        """
+        file_path = "transactions_all_users.json"
+
+        if self.write_transactions(file_path, self.all_transactions()):
+            response = f'All transactions copied and saved to {file_path}'
+        else:
+            response = 'No transactions found.'
+        
+        return response
+
+    def user_transactions(self, client_id):
+        """
+        Yields the transactions of a user with the information of their blocks, using the
+        index of transactions by user id.
+
         Args:
-            client_socket (socket.socket): The client connection socket.
+            client_id (str): The id of the user.
+
+        Yields:
+            dict: The transaction and the information of its block.
         """
-        all_transactions = []
+        for block_index, offset in self.blockchain.tx_index.get(client_id, ()):
+            block = self.blockchain.chain[block_index]
+            yield self.transaction_info(block, block['data'][offset])
 
+    def all_transactions(self):
+        """
+        Yields all the transactions of the blockchain with the information of their blocks.
+
+        Yields:
+            dict: The transaction and the information of its block.
+        """
         for block in self.blockchain.chain:
             if isinstance(block['data'], list):  
                 for transaction in block['data']:
                     if isinstance(transaction, dict):
-                        transaction_info = {
-                            'transaction': transaction,
-                            'block_info': {
-                                'timestamp': block['timestamp'],
-                                'previous_hash': block['previous_hash'],
-                                'proof': block['proof'],
-                                'hash': block['hash']
-                            }
-                        }
-                        all_transactions.append(transaction_info)
-
-        if all_transactions:
-            file_path = "transactions_all_users.json"
-            with open(file_path, 'w') as file:
-                json.dump(all_transactions, file, indent=4)
+                        yield self.transaction_info(block, transaction)
 
-            response = f'All transactions copied and saved to {file_path}'
-        else:
-            response = 'No transactions found.'
-        
-        client_socket.send(Encryption.encrypt_message(self.private_key, response))
+    def transaction_info(self, block, transaction):
+        """
+        Returns a transaction together with the information of the block that contains it.
+
+        Args:
+            block (dict): The block that contains the transaction.
+            transaction (dict): The transaction.
 
-    def handle_verify_integrity(self, client_socket):
+        Returns:
+            dict: The transaction and the information of its block.
         """
-        Verifies the integrity of the blockchain and responds to the client.
+        return {
+            'transaction': transaction,
+            'block_info': {
+                'timestamp': block['timestamp'],
+                'previous_hash': block['previous_hash'],
+                'proof': block['proof'],
+                'hash': block['hash']
+            }
+        }
+
+    def write_transactions(self, file_path, transactions):
+        """
+        Writes transactions to a file as a JSON array, one element at a time, so the whole
+        array is never built in memory. The file is not created if there are no transactions.
 
         Args:
-            client_socket (socket.socket): The client connection socket.
+            file_path (str): The path of the file to write.
+            transactions (iterable): The transactions to write.
+
+        Returns:
+            int: The number of transactions written.
         """
-        is_valid = self.blockchain.verify_integrity()
+        dumps = orjson.dumps if orjson is not None else lambda item: json.dumps(item).encode()
+        transactions = iter(transactions)
+        first = next(transactions, None)
+        if first is None:
+            return 0
+
+        count = 1
+        with open(file_path, 'wb') as file:
+            file.write(b'[' + dumps(first))
+            for transaction in transactions:
+                file.write(b',\n' + dumps(transaction))
+                count += 1
+            file.write(b']\n')
+        return count
+
+    def handle_verify_integrity(self):
+        """
+        Verifies the integrity of the blockchain, without modifying it: pending transactions
+        are not mined, and the chain is read under the chain lock.
+
+        Returns:
+            str: The response for the client.
+        """
+        with self._chain_lock:
+            is_valid, bad_indices = self.blockchain.verify()
         if is_valid:
             response = 'The blockchain is valid and has not been altered.'
-        client_socket.send(Encryption.encrypt_message(self.private_key, response))
+        else:
+            response = f'The blockchain has been altered. Invalid blocks: {", ".join(map(str, bad_indices))}'
+        return response
+
+    def handle_repair_chain(self):
+        """
+        Repairs the invalid blocks of the blockchain. Blocks with invalid transactions are
+        not repaired, and are reported as still invalid.
+
+        Returns:
+            str: The response for the client.
+        """
+        with self._chain_lock:
+            repaired_indices = self.blockchain.repair()
+            is_valid, bad_indices = self.blockchain.verify()
+        if not is_valid:
+            response = f'The blockchain has invalid transactions and cannot be repaired. Invalid blocks: {", ".join(map(str, bad_indices))}'
+        elif repaired_indices:
+            response = f'Repaired blocks: {", ".join(map(str, repaired_indices))}'
+        else:
+            response = 'The blockchain is valid and did not need repairs.'
+        return response
+
+    async def handle_connection(self, reader, writer):
+        """
+        Handles communication with a client on the event loop. Each length-prefixed command is
+        read without blocking, and the decryption, processing and encryption run in a worker
+        thread so that other connections keep being served.
+
+        Args:
+            reader (asyncio.StreamReader): The stream to read commands from.
+            writer (asyncio.StreamWriter): The stream to write responses to.
+        """
+        loop = asyncio.get_running_loop()
+        print(f"Connection from {writer.get_extra_info('peername')}")
+        session_key = None
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                (length,) = HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    break
+                encrypted_message = await reader.readexactly(length)
+
+                session_key, encrypted_response = await loop.run_in_executor(
+                    self._pool, self.handle_frame, encrypted_message, session_key)
+                writer.write(HEADER.pack(len(encrypted_response)) + encrypted_response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """
+        Serves client connections on the event loop until the server is stopped.
+        The proof-of-work process is spawned rather than forked: a forked process would
+        inherit the sockets open when the first block is mined, and a connection closed by
+        the server would then stay open in it.
+        """
+        self.pow_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            server = await asyncio.start_server(self.handle_connection, sock=self.server_socket)
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.flush_mempool()
+            self.pow_executor.shutdown(cancel_futures=True)
+            self.pow_executor = None
+            self.blockchain.close()
 
     def start(self):
         """
-        Starts the server, starting to listen for client connections and assigning
-        threads to handle each connection.
+        Starts the server, listening for client connections on an asyncio event loop.
+        All connections share one thread; the blocking work for each command runs in
+        a pool of at most 'max_workers' threads, so a burst of clients cannot create an
+        unbounded number of threads, and the proof of work runs in a worker process.
+        Transactions are mined in batches, so one proof of work covers up to 'batch_size' of them.
         """
         print(f'Server listening on {self.host}:{self.port}')
-        while True:
-            client_socket, client_address = self.server_socket.accept()
-            print(f'Connection from {client_address}')
-            client_handler = threading.Thread(target=self.handle_client, args=(client_socket,))
-            client_handler.start()
+        asyncio.run(self.serve())
 
 if __name__ == "__main__":
     server = Server()
-    server_thread = threading.Thread(target=server.start)
-    server_thread.start()
\ No newline at end of file
+    server.start()
\ No newline at end of file
@@ -0,0 +1,208 @@
+import os
+import warnings
+
+class PyCryptodomeProvider:
+    """
+    Provider of the RSA-OAEP and AES-GCM operations implemented with PyCryptodome.
+    Always available, since PyCryptodome also parses and stores the keys.
+    PyCryptodome runs AES with the AES-NI instructions when the processor has them and its
+    build includes them; otherwise AES is many times slower, and a warning is issued.
+    """
+
+    name = 'pycryptodome'
+
+    def __init__(self):
+        from Crypto.Util._cpu_features import have_aes_ni
+
+        if not have_aes_ni():
+            warnings.warn('PyCryptodome cannot use AES-NI on this machine: message encryption will be slow. '
+                          'Install a standard PyCryptodome wheel (not a no-asm build) or the cryptography package.',
+                          RuntimeWarning)
+
+    @staticmethod
+    def get_cipher(key):
+        """
+        Returns the OAEP cipher of an RSA key, using SHA-256 both as the OAEP hash and in MGF1.
+        The cipher is created on first use and stored on the key, so encrypting or decrypting
+        many messages with the same key does not build a new cipher each time.
+
+        Args:
+            key (RSA.RsaKey): The RSA key (public or private).
+
+        Returns:
+            PKCS1OAEP_Cipher: The OAEP cipher of the key.
+        """
+        cipher = getattr(key, '_oaep_cipher', None)
+        if cipher is None:
+            from Crypto.Cipher import PKCS1_OAEP
+            from Crypto.Hash import SHA256
+
+            cipher = PKCS1_OAEP.new(key, hashAlgo=SHA256)
+            key._oaep_cipher = cipher
+        return cipher
+
+    def encrypt_oaep(self, public_key, data):
+        """
+        Encrypts data with an RSA public key and the OAEP padding scheme.
+
+        Args:
+            public_key (RSA.RsaKey): The RSA public key.
+            data (bytes): The data to encrypt.
+
+        Returns:
+            bytes: The encrypted data.
+        """
+        return self.get_cipher(public_key).encrypt(data)
+
+    def decrypt_oaep(self, private_key, data):
+        """
+        Decrypts data with an RSA private key and the OAEP padding scheme.
+
+        Args:
+            private_key (RSA.RsaKey): The RSA private key.
+            data (bytes): The encrypted data.
+
+        Returns:
+            bytes: The decrypted data.
+
+        Raises:
+            ValueError: If the data was not encrypted for this key.
+        """
+        return self.get_cipher(private_key).decrypt(data)
+
+    def encrypt_gcm(self, key, nonce, data):
+        """
+        Encrypts data with AES-GCM.
+
+        Args:
+            key (bytes): The AES key.
+            nonce (bytes): The nonce.
+            data (bytes): The data to encrypt.
+
+        Returns:
+            tuple: The ciphertext and the authentication tag.
+        """
+        from Crypto.Cipher import AES
+
+        return AES.new(key, AES.MODE_GCM, nonce=nonce).encrypt_and_digest(data)
+
+    def decrypt_gcm(self, key, nonce, ciphertext, tag):
+        """
+        Decrypts and authenticates data with AES-GCM.
+
+        Args:
+            key (bytes): The AES key.
+            nonce (bytes): The nonce.
+            ciphertext (bytes): The encrypted data.
+            tag (bytes): The authentication tag.
+
+        Returns:
+            bytes: The decrypted data.
+
+        Raises:
+            ValueError: If the data or the tag have been altered.
+        """
+        from Crypto.Cipher import AES
+
+        return AES.new(key, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(ciphertext, tag)
+
+class OpenSSLProvider(PyCryptodomeProvider):
+    """
+    Provider of the RSA-OAEP and AES-GCM operations implemented with OpenSSL through the
+    optional 'cryptography' package, which is faster than PyCryptodome for RSA.
+    The keys are still PyCryptodome keys; each one is converted once to an OpenSSL key,
+    which is stored on it. The output is the same as PyCryptodomeProvider's (OAEP and MGF1
+    with SHA-256), so both ends of a connection can use different providers.
+
+    Raises:
+        ImportError: On creation, if 'cryptography' is not installed.
+    """
+
+    name = 'openssl'
+
+    def __init__(self):
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import padding
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        self._invalid_tag = InvalidTag
+        self._serialization = serialization
+        self._aesgcm = AESGCM
+        self._padding = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+    def get_openssl_key(self, key):
+        """
+        Returns the OpenSSL version of an RSA key, converting it on first use.
+
+        Args:
+            key (RSA.RsaKey): The RSA key (public or private).
+
+        Returns:
+            RSAPublicKey or RSAPrivateKey: The OpenSSL key.
+        """
+        openssl_key = getattr(key, '_openssl_key', None)
+        if openssl_key is None:
+            der = key.export_key(format='DER')
+            if key.has_private():
+                openssl_key = self._serialization.load_der_private_key(der, password=None)
+            else:
+                openssl_key = self._serialization.load_der_public_key(der)
+            key._openssl_key = openssl_key
+        return openssl_key
+
+    def encrypt_oaep(self, public_key, data):
+        """
+        Encrypts data with an RSA public key and the OAEP padding scheme, using OpenSSL.
+        """
+        openssl_key = self.get_openssl_key(public_key)
+        if public_key.has_private():
+            openssl_key = openssl_key.public_key()
+        return openssl_key.encrypt(data, self._padding)
+
+    def decrypt_oaep(self, private_key, data):
+        """
+        Decrypts data with an RSA private key and the OAEP padding scheme, using OpenSSL.
+        """
+        return self.get_openssl_key(private_key).decrypt(data, self._padding)
+
+    def encrypt_gcm(self, key, nonce, data):
+        """
+        Encrypts data with AES-GCM, using OpenSSL. OpenSSL appends the tag to the ciphertext.
+        """
+        encrypted = self._aesgcm(key).encrypt(nonce, data, None)
+        return encrypted[:-16], encrypted[-16:]
+
+    def decrypt_gcm(self, key, nonce, ciphertext, tag):
+        """
+        Decrypts and authenticates data with AES-GCM, using OpenSSL.
+        """
+        try:
+            return self._aesgcm(key).decrypt(nonce, ciphertext + tag, None)
+        except self._invalid_tag:
+            raise ValueError('MAC check failed')
+
+PROVIDERS = {provider.name: provider for provider in (OpenSSLProvider, PyCryptodomeProvider)}
+
+_provider = None
+
+def get_provider():
+    """
+    Returns the provider used by Encryption, choosing it on first use: the one named by the
+    STOCKCHAIN_CRYPTO_PROVIDER environment variable if it is set, otherwise OpenSSL when
+    'cryptography' is installed, falling back to PyCryptodome.
+
+    Returns:
+        PyCryptodomeProvider: The provider.
+    """
+    global _provider
+    if _provider is None:
+        name = os.environ.get('STOCKCHAIN_CRYPTO_PROVIDER')
+        if name:
+            _provider = PROVIDERS[name]()
+        else:
+            try:
+                _provider = OpenSSLProvider()
+            except ImportError:
+                _provider = PyCryptodomeProvider()
+    return _provider
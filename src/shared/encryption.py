@@ -1,13 +1,66 @@
 import os
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
+import mmap
+from functools import lru_cache
+from shared._crypto_providers import PyCryptodomeProvider, get_provider
+
+SESSION_KEY_SIZE = 32
+NONCE_SIZE = 16
+TAG_SIZE = 16
+
+_KEYS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server', 'keys'))
+os.makedirs(_KEYS_DIR, exist_ok=True)
+
+@lru_cache(maxsize=8)
+def _read_key(file_path):
+    """
+    Reads and parses an RSA key file. The file is memory-mapped and parsed from the
+    mapping, without reading it into an intermediate buffer first. The result is cached
+    by path, so a key used by many handlers is only parsed once; 'Encryption.save_key'
+    clears the cache.
+
+    Args:
+        file_path (str): The path of the key file.
+
+    Returns:
+        RSA.RsaKey: The key read from the file.
+    """
+    from Crypto.PublicKey import RSA
+
+    with open(file_path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            return RSA.import_key(bytes(mapped_file))
 
 class Encryption:
     """
     Class that provides static methods for generating RSA keys, saving and loading keys,
-    and encrypting/decrypting messages using RSA with the OAEP padding scheme.
+    and encrypting/decrypting messages with hybrid encryption: each message is encrypted
+    with a random AES-256-GCM session key, and only the session key is encrypted using
+    RSA with the OAEP padding scheme (with SHA-256).
+
+    An encrypted message is laid out as the RSA-encrypted session key (the size of the RSA
+    modulus), followed by the GCM nonce (NONCE_SIZE bytes), the GCM tag (TAG_SIZE bytes)
+    and the AES ciphertext.
+
+    The Crypto modules are imported by the methods that use them, so importing this module
+    (for example in a client that only runs mocked tests) does not pay for loading them.
     """
 
+    @staticmethod
+    def generate_private_key(key_size=2048):
+        """
+        Generates an RSA private key with the public exponent 65537. The private key
+        also holds the public half, for callers that do not need a separate public key.
+
+        Args:
+            key_size (int): The size of the key in bits. Default is 2048 bits.
+
+        Returns:
+            RSA.RsaKey: The generated private key.
+        """
+        from Crypto.PublicKey import RSA
+
+        return RSA.generate(key_size, e=65537)
+
     @staticmethod
     def generate_keys(key_size=2048):
         """
@@ -19,34 +72,42 @@ class Encryption:
         Returns:
             tuple: A tuple containing the generated private key and public key.
         """
-        private_key = RSA.generate(key_size)  
-        public_key = private_key.publickey()  
-        return private_key, public_key
+        private_key = Encryption.generate_private_key(key_size)
+        return private_key, private_key.publickey()
 
     @staticmethod
     def save_key(key, filename):
         """
-        Saves an RSA key (public or private) to a file.
+        Saves an RSA key (public or private) to a file in binary DER format, which is
+        faster to load than PEM. The file is written with a single 'os.write' in most cases,
+        and private keys are only readable by their owner (mode 0o600).
 
         Args:
             key (RSA.RsaKey): The key to save (can be public or private).
             filename (str): The name of the file where the key will be saved.
         """
-        base_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server'))
-        keys_dir = os.path.join(base_path, 'keys')
-        
-        if not os.path.exists(keys_dir):
-            os.makedirs(keys_dir)
+        file_path = os.path.join(_KEYS_DIR, filename)
+        mode = 0o600 if key.has_private() else 0o644
+        data = memoryview(key.export_key(format='DER'))
         
-        file_path = os.path.join(keys_dir, filename)
-        
-        with open(file_path, 'wb') as file:
-            file.write(key.export_key())
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            if hasattr(os, 'fchmod'):
+                os.fchmod(fd, mode)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+        _read_key.cache_clear()
 
     @staticmethod
     def load_key(filename):
         """
-        Loads an RSA key from a file. If the file does not exist, generates new keys.
+        Loads an RSA key from a file, in DER or PEM format. If the file does not exist but a
+        PEM file with the same name does (keys saved by older versions), the PEM key is loaded
+        and saved again under the requested name. If neither exists, generates and saves new
+        keys, and returns the requested one without reading it back from disk.
+        Loaded keys are cached, so loading the same file again returns the same key object.
 
         Args:
             filename (str): The name of the file containing the key to be loaded.
@@ -54,47 +115,224 @@ class Encryption:
         Returns:
             RSA.RsaKey: The key loaded from the file.
         """
-        base_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server'))
-        keys_dir = os.path.join(base_path, 'keys')
-        file_path = os.path.join(keys_dir, filename)
+        file_path = os.path.join(_KEYS_DIR, filename)
         
         if not os.path.exists(file_path):
+            pem_path = os.path.splitext(file_path)[0] + '.pem'
+            if os.path.exists(pem_path):
+                key = _read_key(pem_path)
+                Encryption.save_key(key, filename)
+                return key
+
             private_key, public_key = Encryption.generate_keys()
-            Encryption.save_key(private_key, 'server_private_key.pem')
-            Encryption.save_key(public_key, 'server_public_key.pem')
+            Encryption.save_key(private_key, 'server_private_key.der')
+            Encryption.save_key(public_key, 'server_public_key.der')
+            return private_key if 'private' in filename else public_key
         
-        with open(file_path, 'rb') as file:
-            key = RSA.import_key(file.read())
-        return key
+        return _read_key(file_path)
+
+    @staticmethod
+    def get_cipher(key):
+        """
+        Returns the OAEP cipher of an RSA key, using SHA-256 both as the OAEP hash and in MGF1.
+        The cipher is created on first use and stored on the key, so encrypting or decrypting
+        many messages with the same key does not build a new cipher each time.
+
+        Args:
+            key (RSA.RsaKey): The RSA key (public or private).
+
+        Returns:
+            PKCS1OAEP_Cipher: The OAEP cipher of the key.
+        """
+        return PyCryptodomeProvider.get_cipher(key)
 
     @staticmethod
     def encrypt_message(public_key, message):
         """
-        Encrypts a message using an RSA public key and the OAEP padding scheme.
+        Encrypts a message with a new AES-GCM session key, and the session key using an
+        RSA public key and the OAEP padding scheme. The operations are run by the provider
+        returned by 'get_provider' (OpenSSL when 'cryptography' is installed).
 
         Args:
-            public_key (RSA.RsaKey): The RSA public key used to encrypt the message.
-            message (str): The cleartext message to be encrypted.
+            public_key (RSA.RsaKey): The RSA public key used to encrypt the session key.
+            message (str or bytes): The cleartext message to be encrypted. Strings are encoded
+                in UTF-8; bytes are encrypted as they are.
 
         Returns:
             bytes: The encrypted message.
         """
-        cipher = PKCS1_OAEP.new(public_key)  
-        encrypted_message = cipher.encrypt(message.encode())  
+        provider = get_provider()
+        session_key = os.urandom(SESSION_KEY_SIZE)
+        nonce = os.urandom(NONCE_SIZE)
+        if isinstance(message, str):
+            message = message.encode()
+        ciphertext, tag = provider.encrypt_gcm(session_key, nonce, message)
+        encrypted_session_key = provider.encrypt_oaep(public_key, session_key)
+        encrypted_message = encrypted_session_key + nonce + tag + ciphertext
         return encrypted_message
 
     @staticmethod
-    def decrypt_message(private_key, encrypted_message):
+    def decrypt_message(private_key, encrypted_message, return_bytes=False):
         """
-        Decrypts a message using an RSA private key and the OAEP padding scheme.
+        Decrypts the session key of a message using an RSA private key and the OAEP padding
+        scheme, then decrypts and authenticates the message with it.
 
         Args:
-            private_key (RSA.RsaKey): The RSA private key used to decrypt the message.
+            private_key (RSA.RsaKey): The RSA private key used to decrypt the session key.
             encrypted_message (bytes): The encrypted message to be decrypted.
+            return_bytes (bool): Whether to return the decrypted bytes instead of decoding
+                them as UTF-8 (default False).
 
         Returns:
-            str: The decrypted message in clear text.
+            str or bytes: The decrypted message in clear text.
+
+        Raises:
+            ValueError: If the message was not encrypted for this key or has been altered.
+        """
+        provider = get_provider()
+        key_size = private_key.size_in_bytes()
+        session_key = provider.decrypt_oaep(private_key, encrypted_message[:key_size])
+        nonce = encrypted_message[key_size:key_size + NONCE_SIZE]
+        tag = encrypted_message[key_size + NONCE_SIZE:key_size + NONCE_SIZE + TAG_SIZE]
+        ciphertext = encrypted_message[key_size + NONCE_SIZE + TAG_SIZE:]
+        decrypted_message = provider.decrypt_gcm(session_key, nonce, ciphertext, tag)
+        return decrypted_message if return_bytes else decrypted_message.decode()
+
+    @staticmethod
+    def encrypt_messages(public_key, messages):
+        """
+        Encrypts several messages with the same AES-GCM session key, so the session key is
+        encrypted with RSA once for the whole batch. Each message gets its own nonce, and each
+        result is a complete encrypted message that 'decrypt_message' can decrypt on its own.
+
+        Args:
+            public_key (RSA.RsaKey): The RSA public key used to encrypt the session key.
+            messages (iterable): The cleartext messages (str or bytes) to be encrypted.
+
+        Returns:
+            list: The encrypted messages, in the same order.
+        """
+        provider = get_provider()
+        session_key = os.urandom(SESSION_KEY_SIZE)
+        encrypted_session_key = provider.encrypt_oaep(public_key, session_key)
+
+        encrypted_messages = []
+        for message in messages:
+            if isinstance(message, str):
+                message = message.encode()
+            nonce = os.urandom(NONCE_SIZE)
+            ciphertext, tag = provider.encrypt_gcm(session_key, nonce, message)
+            encrypted_messages.append(encrypted_session_key + nonce + tag + ciphertext)
+        return encrypted_messages
+
+    @staticmethod
+    def decrypt_messages(private_key, encrypted_messages, return_bytes=False):
+        """
+        Decrypts several messages, decrypting each distinct session key with RSA only once,
+        so a batch made by 'encrypt_messages' costs a single RSA operation.
+
+        Args:
+            private_key (RSA.RsaKey): The RSA private key used to decrypt the session keys.
+            encrypted_messages (iterable): The encrypted messages to be decrypted.
+            return_bytes (bool): Whether to return the decrypted bytes instead of decoding
+                them as UTF-8 (default False).
+
+        Returns:
+            list: The decrypted messages, in the same order.
+
+        Raises:
+            ValueError: If a message was not encrypted for this key or has been altered.
+        """
+        provider = get_provider()
+        key_size = private_key.size_in_bytes()
+        session_keys = {}
+
+        decrypted_messages = []
+        for encrypted_message in encrypted_messages:
+            encrypted_session_key = encrypted_message[:key_size]
+            session_key = session_keys.get(encrypted_session_key)
+            if session_key is None:
+                session_key = provider.decrypt_oaep(private_key, encrypted_session_key)
+                session_keys[encrypted_session_key] = session_key
+            nonce = encrypted_message[key_size:key_size + NONCE_SIZE]
+            tag = encrypted_message[key_size + NONCE_SIZE:key_size + NONCE_SIZE + TAG_SIZE]
+            ciphertext = encrypted_message[key_size + NONCE_SIZE + TAG_SIZE:]
+            decrypted_message = provider.decrypt_gcm(session_key, nonce, ciphertext, tag)
+            decrypted_messages.append(decrypted_message if return_bytes else decrypted_message.decode())
+        return decrypted_messages
+
+    @staticmethod
+    def establish_session(public_key):
+        """
+        Creates a session key for a connection and encrypts it using an RSA public key and the
+        OAEP padding scheme. Once the other end has the session key, the messages of the
+        connection can be encrypted with 'encrypt_session_message' and AES-GCM alone, without
+        an RSA operation per message.
+
+        Args:
+            public_key (RSA.RsaKey): The RSA public key used to encrypt the session key.
+
+        Returns:
+            tuple: The session key and the encrypted session key to send to the other end.
+        """
+        session_key = os.urandom(SESSION_KEY_SIZE)
+        return session_key, get_provider().encrypt_oaep(public_key, session_key)
+
+    @staticmethod
+    def open_session(private_key, encrypted_session_key):
+        """
+        Decrypts a session key created by 'establish_session'.
+
+        Args:
+            private_key (RSA.RsaKey): The RSA private key used to decrypt the session key.
+            encrypted_session_key (bytes): The encrypted session key.
+
+        Returns:
+            bytes: The session key.
+
+        Raises:
+            ValueError: If the session key was not encrypted for this key.
+        """
+        return get_provider().decrypt_oaep(private_key, encrypted_session_key)
+
+    @staticmethod
+    def encrypt_session_message(session_key, message):
+        """
+        Encrypts a message with the session key of a connection and AES-GCM.
+
+        Args:
+            session_key (bytes): The session key returned by 'establish_session' or 'open_session'.
+            message (str or bytes): The cleartext message to be encrypted. Strings are encoded
+                in UTF-8; bytes are encrypted as they are.
+
+        Returns:
+            bytes: The encrypted message: the nonce, the tag and the ciphertext.
+        """
+        nonce = os.urandom(NONCE_SIZE)
+        if isinstance(message, str):
+            message = message.encode()
+        ciphertext, tag = get_provider().encrypt_gcm(session_key, nonce, message)
+        return nonce + tag + ciphertext
+
+    @staticmethod
+    def decrypt_session_message(session_key, encrypted_message, return_bytes=False):
+        """
+        Decrypts and authenticates a message encrypted by 'encrypt_session_message'.
+
+        Args:
+            session_key (bytes): The session key of the connection.
+            encrypted_message (bytes): The encrypted message to be decrypted.
+            return_bytes (bool): Whether to return the decrypted bytes instead of decoding
+                them as UTF-8 (default False).
+
+        Returns:
+            str or bytes: The decrypted message in clear text.
+
+        Raises:
+            ValueError: If the message was not encrypted with this session key or has been altered.
         """
-        cipher = PKCS1_OAEP.new(private_key)  
-        decrypted_message = cipher.decrypt(encrypted_message).decode() 
-        return decrypted_message
\ No newline at end of file
+        nonce = encrypted_message[:NONCE_SIZE]
+        tag = encrypted_message[NONCE_SIZE:NONCE_SIZE + TAG_SIZE]
+        ciphertext = encrypted_message[NONCE_SIZE + TAG_SIZE:]
+        decrypted_message = get_provider().decrypt_gcm(session_key, nonce, ciphertext, tag)
+        return decrypted_message if return_bytes else decrypted_message.decode()
@@ -0,0 +1,99 @@
+import struct
+
+HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+SCATTER_GATHER_THRESHOLD = 4096
+
+class Framing:
+    """
+    Class that provides static methods for sending and receiving length-prefixed messages
+    over a stream socket. Each message is preceded by its length as a 4-byte big-endian
+    unsigned integer, so messages of any size arrive whole instead of being cut at the
+    size of a single 'recv' call.
+    """
+
+    @staticmethod
+    def send_frame(sock, payload):
+        """
+        Sends a payload preceded by its length. Small payloads are concatenated with the
+        header and sent with one 'sendall'; payloads of SCATTER_GATHER_THRESHOLD bytes or more
+        are sent with 'sendmsg' straight from the header and payload buffers, without copying
+        the payload.
+
+        Args:
+            sock (socket.socket): The connected socket.
+            payload (bytes): The payload to send.
+        """
+        header = HEADER.pack(len(payload))
+        if len(payload) < SCATTER_GATHER_THRESHOLD:
+            sock.sendall(header + payload)
+            return
+
+        buffers = [memoryview(header), memoryview(payload)]
+        first = 0
+        while first < len(buffers):
+            sent = sock.sendmsg(buffers[first:])
+            while first < len(buffers) and sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+            if sent:
+                buffers[first] = buffers[first][sent:]
+
+    @staticmethod
+    def recv_exact(sock, n, buffer):
+        """
+        Receives exactly n bytes into the beginning of a reusable buffer.
+
+        Args:
+            sock (socket.socket): The connected socket.
+            n (int): The number of bytes to receive.
+            buffer (bytearray): The buffer to receive into. It is grown if it is smaller than n.
+
+        Returns:
+            bool: True if n bytes were received, False if the connection was closed
+            before any byte arrived.
+
+        Raises:
+            ConnectionError: If the connection is closed in the middle of the n bytes.
+        """
+        if len(buffer) < n:
+            buffer.extend(bytes(n - len(buffer)))
+
+        offset = 0
+        with memoryview(buffer) as view:
+            while offset < n:
+                received = sock.recv_into(view[offset:n], n - offset)
+                if not received:
+                    if offset == 0:
+                        return False
+                    raise ConnectionError('Connection closed in the middle of a message')
+                offset += received
+        return True
+
+    @staticmethod
+    def recv_frame(sock, buffer):
+        """
+        Receives one length-prefixed payload.
+
+        Args:
+            sock (socket.socket): The connected socket.
+            buffer (bytearray): A buffer reused between calls to avoid allocating per message.
+
+        Returns:
+            bytes or None: The payload, or None if the connection was closed cleanly.
+
+        Raises:
+            ConnectionError: If the connection is closed in the middle of a message.
+            ValueError: If the announced length is larger than MAX_FRAME_SIZE.
+        """
+        if not Framing.recv_exact(sock, HEADER.size, buffer):
+            return None
+
+        (length,) = HEADER.unpack_from(buffer)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f'Message of {length} bytes exceeds the maximum of {MAX_FRAME_SIZE}')
+
+        if length and not Framing.recv_exact(sock, length, buffer):
+            raise ConnectionError('Connection closed in the middle of a message')
+        with memoryview(buffer) as view:
+            return bytes(view[:length])
@@ -0,0 +1,125 @@
+import pytest
+from shared.encryption import Encryption, SESSION_KEY_SIZE
+from server.server import Server
+
+def pytest_configure(config):
+    """
+    Registers the 'xdist_group' marker, so the tests that use it also run without warnings
+    when pytest-xdist is not installed.
+
+    Args:
+        config (pytest.Config): The pytest configuration.
+    """
+    config.addinivalue_line("markers", "xdist_group(name): run the marked tests on the same pytest-xdist worker")
+
+@pytest.fixture(scope="session")
+def rsa_keypair():
+    """
+    Fixture that generates one RSA key pair shared by every test of the session,
+    so the tests do not pay for generating new keys each time. The keys are 1024 bits,
+    which is enough for the tests and faster to generate than the default 2048 bits.
+
+    Returns:
+        tuple: The private key and the public key.
+    """
+    return Encryption.generate_keys(1024)
+
+@pytest.fixture(scope="session")
+def rsa_other_keypair():
+    """
+    Fixture that generates a second RSA key pair shared by every test of the session,
+    for the tests that need a key different from 'rsa_keypair'.
+
+    Returns:
+        tuple: The private key and the public key.
+    """
+    return Encryption.generate_keys(1024)
+
+@pytest.fixture(scope="session", autouse=True)
+def warm_up_encryption():
+    """
+    Fixture that pays the one-time costs of encryption before the first test runs, so they
+    are not charged to whichever test encrypts first: choosing the crypto provider (which
+    detects the CPU features and loads its native libraries) and building an AES-GCM cipher.
+    """
+    session_key = bytes(SESSION_KEY_SIZE)
+    Encryption.decrypt_session_message(session_key, Encryption.encrypt_session_message(session_key, 'warmup'))
+
+@pytest.fixture
+def unstarted_server(tmp_path):
+    """
+    Fixture that creates a server on a free port without starting it, with a new blockchain
+    and users file in a temporary folder, and closes it at the end of the test.
+
+    Args:
+        tmp_path (pathlib.Path): Temporary folder for the data of the server.
+
+    Yields:
+        Server: The server.
+    """
+    server = Server(port=0, blockchain_dir=str(tmp_path / 'blockchain_data'),
+                    users_file=str(tmp_path / 'users_data' / 'users.json'))
+    yield server
+    with server._timer_lock:
+        if server._flush_timer is not None:
+            server._flush_timer.cancel()
+    server.blockchain.close()
+    server.server_socket.close()
+
+class NullEncryption:
+    """
+    Encryption backend for tests that does no cryptography: keys are not loaded and
+    messages are only encoded to and decoded from UTF-8.
+    """
+
+    @staticmethod
+    def load_key(filename):
+        """
+        Returns no key.
+
+        Args:
+            filename (str): The name of the key file (ignored).
+
+        Returns:
+            None: There are no keys.
+        """
+        return None
+
+    @staticmethod
+    def encrypt_message(key, message):
+        """
+        Encodes a message without encrypting it.
+
+        Args:
+            key: The key (ignored).
+            message (str or bytes): The message.
+
+        Returns:
+            bytes: The message encoded in UTF-8.
+        """
+        return message.encode() if isinstance(message, str) else message
+
+    @staticmethod
+    def decrypt_message(key, encrypted_message, return_bytes=False):
+        """
+        Decodes a message without decrypting it.
+
+        Args:
+            key: The key (ignored).
+            encrypted_message (bytes): The message encoded in UTF-8.
+            return_bytes (bool): Whether to return the bytes without decoding them.
+
+        Returns:
+            str or bytes: The decoded message.
+        """
+        return encrypted_message if return_bytes else encrypted_message.decode()
+
+@pytest.fixture
+def null_backend():
+    """
+    Fixture that provides the encryption backend that does no cryptography.
+
+    Returns:
+        NullEncryption: The backend.
+    """
+    return NullEncryption()
@@ -23,6 +23,7 @@ def temp_blockchain():
     blockchain.blockchain_dir = temp_dir  
     blockchain.load_chain_from_json()
     yield blockchain
+    blockchain.close()
     shutil.rmtree(temp_dir)
     
 def test_create_genesis_block(temp_blockchain):
@@ -217,3 +218,315 @@ def test_empty_chain_before_genesis(temp_blockchain):
     blockchain.chain = [] 
     blockchain.create_genesis_block() 
     assert len(blockchain.chain) == 1
+
+def test_is_valid_chain_checks_new_blocks(temp_blockchain):
+    """
+    Test to verify that incremental validation still checks newly appended blocks.
+
+    After a successful validation, a block with a broken 'previous_hash' link is appended
+    and the chain must be reported as invalid.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    last_block = blockchain.last_block
+    blockchain.create_block(blockchain.proof_of_work(last_block['proof']))
+    assert blockchain.is_valid_chain() == True
+
+    blockchain.chain.append({
+        'index': len(blockchain.chain),
+        'timestamp': '2024-01-01 00:00:00',
+        'data': [],
+        'previous_hash': 'tampered',
+        'proof': 0,
+        'hash': 'tampered'
+    })
+    assert blockchain.is_valid_chain() == False
+
+def test_create_block_uses_stored_previous_hash(temp_blockchain):
+    """
+    Test to verify that a block created without an explicit previous hash links to the last block.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    last_block = blockchain.last_block
+    block = blockchain.create_block(blockchain.proof_of_work(last_block['proof']))
+    assert block['previous_hash'] == last_block['hash'] == blockchain.hash(last_block)
+
+def test_proof_of_work_is_valid_proof(temp_blockchain):
+    """
+    Test to verify that the proof found by 'proof_of_work' satisfies 'valid_proof'.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    last_proof = blockchain.last_block['proof']
+    proof = blockchain.proof_of_work(last_proof)
+
+    assert blockchain.valid_proof(last_proof, proof)
+    assert not any(blockchain.valid_proof(last_proof, p) for p in range(proof))
+
+def test_proof_of_work_parallel(temp_blockchain):
+    """
+    Test to verify that the parallel 'proof of work' returns a valid proof.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    last_proof = blockchain.last_block['proof']
+    proof = blockchain.proof_of_work_parallel(last_proof, workers=2)
+
+    assert isinstance(proof, int)
+    assert blockchain.valid_proof(last_proof, proof)
+
+def test_hash_uses_cached_serialization(temp_blockchain):
+    """
+    Test to verify that the cached serialization gives the same hash as a fresh one
+    and is not written to disk.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    last_block = blockchain.last_block
+    block = blockchain.create_block(blockchain.proof_of_work(last_block['proof']))
+
+    assert '_canon' in block
+    uncached_block = {key: value for key, value in block.items() if key != '_canon'}
+    assert blockchain.hash(block) == blockchain.hash(uncached_block) == block['hash']
+
+    blockchain.chain = []
+    blockchain.load_chain_from_json()
+    stored_block = blockchain.chain[-1]
+    assert stored_block['hash'] == blockchain.hash(stored_block) == block['hash']
+
+def test_load_chain_from_legacy_files_and_log(temp_blockchain):
+    """
+    Test to verify that legacy per-block JSON files are loaded in numeric index order
+    and that records of the chain log replace the legacy blocks with the same index.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    for index in range(12):
+        block = {'index': index, 'timestamp': '2024-01-01 00:00:00', 'data': [], 'previous_hash': '0', 'proof': index}
+        block['hash'] = blockchain.hash(block)
+        with open(os.path.join(blockchain.blockchain_dir, f'block_{index}.json'), 'w') as f:
+            json.dump(block, f, indent=4)
+
+    replaced_block = dict(block, proof=100)
+    blockchain.save_block_to_json(replaced_block)
+
+    blockchain.chain = []
+    blockchain.load_chain_from_json()
+
+    assert [block['index'] for block in blockchain.chain] == list(range(12))
+    assert blockchain.chain[11]['proof'] == 100
+
+def test_transactions_indexed_by_user(temp_blockchain):
+    """
+    Test to verify that the transactions of a new block are indexed by user id.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    blockchain.add_transaction({'user_id': 'index-user', 'operation_type': 'buy', 'stock_name': 'AAPL'})
+    blockchain.add_transaction({'user_id': 'other-user', 'operation_type': 'sell', 'stock_name': 'MSFT'})
+    block = blockchain.create_block(blockchain.proof_of_work(blockchain.last_block['proof']))
+
+    assert blockchain.tx_index['index-user'] == [(block['index'], 0)]
+    assert blockchain.tx_index['other-user'] == [(block['index'], 1)]
+
+def test_has_valid_transactions(temp_blockchain):
+    """
+    Test to verify that the columnar validation of a block agrees with 'is_valid_transaction'.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    transactions = [
+        {'user_id': '1', 'operation_type': 'buy', 'stock_name': 'AAPL'},
+        {'user_id': '2', 'operation_type': 'sell', 'stock_name': 'MSFT'}
+    ]
+    invalid_transactions = [
+        {'user_id': '1', 'operation_type': 'hold', 'stock_name': 'AAPL'},
+        {'user_id': '1', 'operation_type': 'buy', 'stock_name': ''},
+        {'user_id': '1', 'stock_name': 'AAPL'},
+        'not a transaction'
+    ]
+
+    block = {'data': transactions}
+    assert blockchain.has_valid_transactions(block)
+    assert blockchain.columns(block) == {'user_ids': ('1', '2'), 'ops': b'\x00\x01', 'stocks': ('AAPL', 'MSFT')}
+
+    for invalid_transaction in invalid_transactions:
+        assert not blockchain.has_valid_transactions({'data': transactions + [invalid_transaction]})
+    assert not blockchain.has_valid_transactions({'data': 'Genesis Block'})
+
+def test_has_valid_transactions_is_cached(temp_blockchain):
+    """
+    Test to verify that the validation result of a block is cached and not written to disk.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    blockchain.add_transaction({'user_id': '1', 'operation_type': 'buy', 'stock_name': 'AAPL'})
+    block = blockchain.create_block(blockchain.proof_of_work(blockchain.last_block['proof']))
+
+    assert blockchain.is_valid_chain()
+    assert block['_valid'] is True
+
+    blockchain.chain = []
+    blockchain.load_chain_from_json()
+    assert '_valid' not in blockchain.chain[-1]
+
+def test_verify_reports_altered_blocks(temp_blockchain):
+    """
+    Test to verify that 'verify' reports blocks altered in memory without modifying the chain
+    or the files on disk, and that 'repair' fixes them and returns the blocks it rewrote.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    blockchain.chain = []
+    blockchain.create_genesis_block()
+    for stock_name in ('AAPL', 'MSFT'):
+        blockchain.add_transaction({'user_id': '1', 'operation_type': 'buy', 'stock_name': stock_name})
+        blockchain.create_block(blockchain.proof_of_work(blockchain.last_block['proof']))
+
+    assert blockchain.verify() == (True, [])
+
+    blockchain.chain[1]['previous_hash'] = 'altered'
+    files_before = {name: os.path.getsize(os.path.join(blockchain.blockchain_dir, name)) for name in os.listdir(blockchain.blockchain_dir)}
+
+    assert blockchain.verify() == (False, [1, 2])
+    assert blockchain.verify_integrity() == False
+    assert blockchain.chain[1]['previous_hash'] == 'altered'
+    assert files_before == {name: os.path.getsize(os.path.join(blockchain.blockchain_dir, name)) for name in os.listdir(blockchain.blockchain_dir)}
+
+    assert blockchain.repair() == [1]
+    assert blockchain.verify() == (True, [])
+
+    blockchain.chain[1]['data'][0]['stock_name'] = 'GOOG'
+    assert blockchain.verify() == (False, [1, 2])
+    assert blockchain.repair() == [1, 2]
+    assert blockchain.verify() == (True, [])
+
+    blockchain.chain = []
+    blockchain.load_chain_from_json()
+    assert blockchain.verify() == (True, [])
+
+def test_repair_refuses_invalid_transactions(temp_blockchain):
+    """
+    Test to verify that 'repair' does not hash again a block whose transaction was altered
+    into an invalid one, so the chain stays invalid, even after the block was validated once.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    blockchain.chain = []
+    blockchain.create_genesis_block()
+    for stock_name in ('AAPL', 'MSFT'):
+        blockchain.add_transaction({'user_id': '1', 'operation_type': 'buy', 'stock_name': stock_name})
+        blockchain.create_block(blockchain.proof_of_work(blockchain.last_block['proof']))
+    assert blockchain.is_valid_chain()
+
+    transaction = blockchain.chain[1]['data'][0]
+    transaction['operation_type'] = 'steal'
+
+    assert blockchain.repair() == []
+    assert not blockchain.is_valid_transaction(transaction)
+    assert not blockchain.is_valid_chain()
+    assert blockchain.verify() == (False, [1, 2])
+
+def test_create_block_drains_pending_transactions(temp_blockchain):
+    """
+    Test to verify that creating a block moves the pending transactions into a list in the
+    block and leaves the pending queue empty for the next transactions.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    pending = blockchain.current_transactions
+    blockchain.add_transaction({'user_id': '1', 'operation_type': 'buy', 'stock_name': 'AAPL'})
+    block = blockchain.create_block(blockchain.proof_of_work(blockchain.last_block['proof']))
+
+    assert block['data'] == [{'user_id': '1', 'operation_type': 'buy', 'stock_name': 'AAPL'}]
+    assert blockchain.current_transactions is pending
+    assert len(pending) == 0
+
+    blockchain.add_transaction({'user_id': '2', 'operation_type': 'sell', 'stock_name': 'MSFT'})
+    assert len(block['data']) == 1
+
+def test_reload_rebuilds_transaction_index(temp_blockchain):
+    """
+    Test to verify that loading the chain again does not add the transactions to the index
+    twice, and that closing the chain log lets the next block open it again.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+    """
+    blockchain = temp_blockchain
+    blockchain.chain = []
+    blockchain.create_genesis_block()
+    blockchain.add_transaction({'user_id': '1', 'operation_type': 'buy', 'stock_name': 'AAPL'})
+    blockchain.create_block(blockchain.proof_of_work(blockchain.last_block['proof']))
+    blockchain.close()
+
+    blockchain.chain = []
+    blockchain.load_chain_from_json()
+    assert blockchain.tx_index['1'] == [(1, 0)]
+    assert blockchain.is_valid_chain()
+
+    blockchain.add_transaction({'user_id': '1', 'operation_type': 'sell', 'stock_name': 'AAPL'})
+    blockchain.create_block(blockchain.proof_of_work(blockchain.last_block['proof']))
+    blockchain.chain = []
+    blockchain.load_chain_from_json()
+    assert blockchain.tx_index['1'] == [(1, 0), (2, 0)]
+
+@pytest.mark.parametrize('use_msgpack', [True, False])
+def test_torn_write_truncated_before_next_block(temp_blockchain, monkeypatch, use_msgpack):
+    """
+    Test to verify that a last record cut short by an interrupted write is dropped from the
+    chain log when the chain is loaded, so the next block saved is read back after a restart.
+
+    Args:
+        temp_blockchain (Blockchain): Blockchain instance provided by the fixture.
+        monkeypatch (pytest.MonkeyPatch): Fixture used to save the blocks as JSON without msgpack.
+        use_msgpack (bool): Whether the chain log is written with msgpack.
+    """
+    if not use_msgpack:
+        monkeypatch.setattr('server.blockchain.msgpack', None)
+    blockchain = temp_blockchain
+    blockchain.chain = []
+    blockchain.create_genesis_block()
+    for stock_name in ('AAPL', 'MSFT'):
+        blockchain.add_transaction({'user_id': '1', 'operation_type': 'buy', 'stock_name': stock_name})
+        blockchain.create_block(blockchain.proof_of_work(blockchain.last_block['proof']))
+    log = blockchain.open_chain_log()
+    blockchain.close()
+    os.truncate(log.name, os.path.getsize(log.name) - 5)
+
+    reloaded = Blockchain(blockchain.blockchain_dir)
+    assert len(reloaded.chain) == 2
+    reloaded.add_transaction({'user_id': '1', 'operation_type': 'sell', 'stock_name': 'GOOG'})
+    reloaded.create_block(reloaded.proof_of_work(reloaded.last_block['proof']))
+    reloaded.close()
+
+    restarted = Blockchain(blockchain.blockchain_dir)
+    restarted.close()
+    assert [block['index'] for block in restarted.chain] == [0, 1, 2]
+    assert restarted.chain[2]['data'][0]['stock_name'] == 'GOOG'
+    assert restarted.verify() == (True, [])
@@ -1,8 +1,34 @@
 import pytest
 from unittest import mock
 from client.client import Client
+from shared.framing import HEADER
 import socket
 
+FRAMED_MESSAGE = HEADER.pack(len(b'encrypted_message')) + b'encrypted_message'
+
+def fake_recv_into(payload=b'encrypted_response'):
+    """
+    Builds a replacement for `socket.recv_into` that always has one length-prefixed
+    server response ready to be read.
+
+    Args:
+        payload (bytes): The payload of every response.
+
+    Returns:
+        function: A function with the same signature as `socket.recv_into`.
+    """
+    pending = bytearray()
+
+    def recv_into(view, nbytes=0):
+        if not pending:
+            pending.extend(HEADER.pack(len(payload)) + payload)
+        n = min(nbytes or len(view), len(pending))
+        view[:n] = pending[:n]
+        del pending[:n]
+        return n
+
+    return recv_into
+
 @pytest.fixture
 def mock_socket():
     """
@@ -15,50 +41,71 @@ def mock_socket():
         mock.Mock: A mock object that replaces `socket.socket` in tests.
     """
     with mock.patch('socket.socket') as mock_socket:
+        mock_socket.return_value.recv_into.side_effect = fake_recv_into()
         yield mock_socket
 
-def test_client_connection(mock_socket):
+@pytest.fixture
+def client(mock_socket, null_backend):
+    """
+    A fixture that creates a `Client` connected through the socket mock.
+
+    The client uses the backend that does no cryptography, so no keys are loaded and the
+    tests only patch the backend methods whose results they check.
+
+    Args:
+        mock_socket (mock. Mock): The socket mock the client connects through.
+        null_backend (NullEncryption): The backend that does no cryptography.
+
+    Returns:
+        Client: The client under test.
+    """
+    return Client(backend=null_backend)
+
+def test_client_connection(mock_socket, null_backend):
     """
     Test that verifies the correct creation and connection of the socket on the client.
 
     This test verifies that the `Client` connects to the server using the mocked socket.
-    It verifies that the socket has been created with the correct settings (AF_INET and SOCK_STREAM)
-    and that the `connect` method has been called with the correct address ('localhost', 5000).
+    It verifies that the socket has been created with the correct settings (AF_INET and SOCK_STREAM),
+    that Nagle's algorithm is disabled with TCP_NODELAY, and that the `connect` method has been
+    called with the correct address ('localhost', 5000).
 
     Args:
         mock_socket (mock. Mock): The socket mock to simulate the connection.
+        null_backend (NullEncryption): The backend that does no cryptography.
     """
     mock_socket_instance = mock_socket.return_value
     mock_socket_instance.connect = mock.MagicMock()
 
-    client = Client()
+    client = Client(backend=null_backend)
 
     mock_socket.assert_called_once_with(socket.AF_INET, socket.SOCK_STREAM)
+    mock_socket_instance.setsockopt.assert_called_once_with(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     mock_socket_instance.connect.assert_called_once_with(('localhost', 5000))
 
-def test_send_message(mock_socket):
+def test_send_message(mock_socket, client):
     """
     Test that verifies the sending of an encrypted message from the client.
 
     This test verifies that the message is correctly encrypted before being sent through the
-    socket. It uses a mock for the `Encryption` class to simulate the encryption of the message.
+    socket. It uses a mock of the backend to simulate the encryption of the message.
 
     Args:
         mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
     """
-    with mock.patch('shared.encryption.Encryption.encrypt_message') as mock_encrypt:
+    with mock.patch.object(client.backend, 'encrypt_message') as mock_encrypt:
         mock_encrypt.return_value = b'encrypted_message'
 
-        client = Client()
         message = "Test message"
 
         client.send_message(message)
 
         mock_encrypt.assert_called_once_with(client.public_key, message)
         
-        mock_socket.return_value.send.assert_called_once_with(b'encrypted_message')
+        mock_socket.return_value.sendall.assert_called_once_with(FRAMED_MESSAGE)
 
-def test_register(mock_socket):
+def test_register(mock_socket, client):
     """
     Test that verifies the registration of a new user on the client.
 
@@ -68,23 +115,22 @@ def test_register(mock_socket):
 
     Args:
         mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
     """
-    with mock.patch('shared.encryption.Encryption.decrypt_message') as mock_decrypt, \
-         mock.patch('shared.encryption.Encryption.encrypt_message') as mock_encrypt:
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt, \
+         mock.patch.object(client.backend, 'encrypt_message') as mock_encrypt:
 
         mock_encrypt.return_value = b'encrypted_message'
         mock_decrypt.return_value = '1234'  
 
-        client = Client()
-
         client.register('testuser')
 
-        mock_socket.return_value.send.assert_called_once_with(b'encrypted_message')
+        mock_socket.return_value.sendall.assert_called_once_with(FRAMED_MESSAGE)
 
         assert client.client_id == '1234'
         assert client.username == 'testuser'
 
-def test_add_transaction(mock_socket):
+def test_add_transaction(mock_socket, client):
     """
     Test that verifies the process of adding a transaction.
 
@@ -93,22 +139,21 @@ def test_add_transaction(mock_socket):
 
     Args:
         mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
     """
-    with mock.patch('shared.encryption.Encryption.decrypt_message') as mock_decrypt, \
-         mock.patch('shared.encryption.Encryption.encrypt_message') as mock_encrypt:
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt, \
+         mock.patch.object(client.backend, 'encrypt_message') as mock_encrypt:
 
         mock_decrypt.return_value = 'Transaction Added'
         mock_encrypt.return_value = b'encrypted_message'
 
-        client = Client()
-
         client.add_transaction('testuser', 'buy', 'AAPL')
 
-        mock_socket.return_value.send.assert_called_once_with(b'encrypted_message')
+        mock_socket.return_value.sendall.assert_called_once_with(FRAMED_MESSAGE)
 
         assert mock_decrypt.call_count == 1
 
-def test_verify(mock_socket):
+def test_verify(mock_socket, client):
     """
     Test that verifies the blockchain verification by the client.
 
@@ -117,22 +162,44 @@ def test_verify(mock_socket):
 
     Args:
         mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
     """
-    with mock.patch('shared.encryption.Encryption.decrypt_message') as mock_decrypt, \
-         mock.patch('shared.encryption.Encryption.encrypt_message') as mock_encrypt:
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt, \
+         mock.patch.object(client.backend, 'encrypt_message') as mock_encrypt:
 
         mock_decrypt.return_value = 'Chain Verified'
         mock_encrypt.return_value = b'encrypted_message'
 
-        client = Client()
-
         client.verify()
 
-        mock_socket.return_value.send.assert_called_once_with(b'encrypted_message')
+        mock_socket.return_value.sendall.assert_called_once_with(FRAMED_MESSAGE)
 
         assert mock_decrypt.call_count == 1
 
-def test_receive_error(mock_socket):
+def test_repair(mock_socket, client):
+    """
+    Test that verifies the blockchain repair requested by the client.
+
+    This test simulates the repair request sent by the client, ensuring that the
+    message is sent to the server and the response is received.
+
+    Args:
+        mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
+    """
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt, \
+         mock.patch.object(client.backend, 'encrypt_message') as mock_encrypt:
+
+        mock_decrypt.return_value = 'Repaired blocks: 1'
+        mock_encrypt.return_value = b'encrypted_message'
+
+        client.repair()
+
+        mock_socket.return_value.sendall.assert_called_once_with(FRAMED_MESSAGE)
+
+        assert mock_decrypt.call_count == 1
+
+def test_receive_error(mock_socket, client):
     """
     Test that simulates an error in receiving a message and verifies proper handling.
 
@@ -140,16 +207,15 @@ def test_receive_error(mock_socket):
 
     Args:
         mock_socket (mock. Mock): The mock of the socket used in testing.
+        client (Client): The client provided by the fixture.
     """
-    with mock.patch('shared.encryption.Encryption.decrypt_message') as mock_decrypt:
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt:
         mock_decrypt.side_effect = Exception("Decryption failed")
 
-        client = Client()
-
         with pytest.raises(Exception):
             client.receive_message()
 
-def test_interactive_mode(mock_socket):
+def test_interactive_mode(mock_socket, client):
     """
     Test that verifies the operation of the interactive mode of the client.
 
@@ -158,19 +224,18 @@ def test_interactive_mode(mock_socket):
 
     Args:
         mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
     """
     with mock.patch('builtins.input', return_value='exit'), \
-         mock.patch('shared.encryption.Encryption.decrypt_message') as mock_decrypt:
+         mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt:
         
         mock_decrypt.return_value = 'Exit command received'
 
-        client = Client()
-
         client.interactive_mode()
 
         mock_socket.return_value.close.assert_called_once()
 
-def test_copy_all_transactions(mock_socket):
+def test_copy_all_transactions(mock_socket, client):
     """
     Test that verifies the copying of all transactions from the server.
 
@@ -179,23 +244,22 @@ def test_copy_all_transactions(mock_socket):
 
     Args:
         mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
     """
-    with mock.patch('shared.encryption.Encryption.decrypt_message') as mock_decrypt, \
-         mock.patch('shared.encryption.Encryption.encrypt_message') as mock_encrypt:
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt, \
+         mock.patch.object(client.backend, 'encrypt_message') as mock_encrypt:
 
         mock_decrypt.return_value = 'All transactions copied'
         mock_encrypt.return_value = b'encrypted_message'
 
-        client = Client()
-
         client.copy()
 
-        mock_socket.return_value.send.assert_called_once_with(b'encrypted_message')
+        mock_socket.return_value.sendall.assert_called_once_with(FRAMED_MESSAGE)
 
         assert mock_decrypt.call_count == 1
 
 
-def test_copy_user_transaction(mock_socket):
+def test_copy_user_transaction(mock_socket, client):
     """
     Test that verifies the copying of a specific user's transactions from the server.
 
@@ -204,23 +268,22 @@ def test_copy_user_transaction(mock_socket):
 
     Args:
         mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
     """
-    with mock.patch('shared.encryption.Encryption.decrypt_message') as mock_decrypt, \
-         mock.patch('shared.encryption.Encryption.encrypt_message') as mock_encrypt:
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt, \
+         mock.patch.object(client.backend, 'encrypt_message') as mock_encrypt:
 
         mock_decrypt.return_value = 'User transactions copied'
         mock_encrypt.return_value = b'encrypted_message'
 
-        client = Client()
-
         client.copy('testuser')
 
-        mock_socket.return_value.send.assert_called_once_with(b'encrypted_message')
+        mock_socket.return_value.sendall.assert_called_once_with(FRAMED_MESSAGE)
 
         assert mock_decrypt.call_count == 1
 
 
-def test_recieve_id(mock_socket):
+def test_recieve_id(mock_socket, client):
     """
     Test that verifies that the client receives a user ID after registration.
 
@@ -230,21 +293,20 @@ def test_recieve_id(mock_socket):
 
     Args:
     mock_socket (mock. Mock): The mock of the socket used in testing.
+        client (Client): The client provided by the fixture.
     """
-    with mock.patch('shared.encryption.Encryption.decrypt_message') as mock_decrypt, \
-         mock.patch('shared.encryption.Encryption.encrypt_message') as mock_encrypt:
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt, \
+         mock.patch.object(client.backend, 'encrypt_message') as mock_encrypt:
 
         mock_decrypt.return_value = '1234'
         mock_encrypt.return_value = b'encrypted_message'
 
-        client = Client()
-
         client.register('testuser')
 
         assert client.client_id == '1234'
 
 
-def test_send_encrypted_transaction(mock_socket):
+def test_send_encrypted_transaction(mock_socket, client):
     """
     Test that verifies the sending of an encrypted transaction from the client.
 
@@ -253,23 +315,22 @@ def test_send_encrypted_transaction(mock_socket):
 
     Args:
         mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
     """
-    with mock.patch('shared.encryption.Encryption.decrypt_message') as mock_decrypt, \
-         mock.patch('shared.encryption.Encryption.encrypt_message') as mock_encrypt:
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt, \
+         mock.patch.object(client.backend, 'encrypt_message') as mock_encrypt:
 
         mock_decrypt.return_value = 'Transaction added'
         mock_encrypt.return_value = b'encrypted_message'
 
-        client = Client()
-
         client.add_transaction('testuser', 'buy', 'AAPL')
 
-        mock_socket.return_value.send.assert_called_once_with(b'encrypted_message')
+        mock_socket.return_value.sendall.assert_called_once_with(FRAMED_MESSAGE)
 
         assert mock_decrypt.call_count == 1
 
 
-def test_send_transaction_with_missing_fields(mock_socket):
+def test_send_transaction_with_missing_fields(mock_socket, client):
     """
     Test that verifies the handling of a transaction with missing fields.
 
@@ -278,18 +339,56 @@ def test_send_transaction_with_missing_fields(mock_socket):
 
     Args:
         mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
     """
-    with mock.patch('shared.encryption.Encryption.decrypt_message') as mock_decrypt, \
-         mock.patch('shared.encryption.Encryption.encrypt_message') as mock_encrypt:
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt, \
+         mock.patch.object(client.backend, 'encrypt_message') as mock_encrypt:
 
         mock_decrypt.return_value = 'Error: Missing fields'
         mock_encrypt.return_value = b'encrypted_message'
 
-        client = Client()
-
         client.add_transaction('testuser', 'buy', '')  
 
-        mock_socket.return_value.send.assert_called_once_with(b'encrypted_message')
+        mock_socket.return_value.sendall.assert_called_once_with(FRAMED_MESSAGE)
 
         assert mock_decrypt.call_count == 1
-        assert 'Error: Missing fields' in mock_decrypt.return_value
\ No newline at end of file
+        assert 'Error: Missing fields' in mock_decrypt.return_value
+
+def test_receive_message_uses_cached_private_key(mock_socket, client):
+    """
+    Test that verifies that receiving messages decrypts with the private key loaded at
+    construction time instead of loading the key again for every message.
+
+    Args:
+        mock_socket (mock. Mock): The mock of the socket used in the tests.
+        client (Client): The client provided by the fixture.
+    """
+    with mock.patch.object(client.backend, 'decrypt_message') as mock_decrypt:
+        mock_decrypt.return_value = 'response'
+
+        with mock.patch.object(client.backend, 'load_key') as mock_load_key:
+            client.receive_message()
+            client.receive_message()
+
+        mock_load_key.assert_not_called()
+        mock_decrypt.assert_called_with(client.private_key, b'encrypted_response')
+
+def test_client_with_null_backend(mock_socket, null_backend):
+    """
+    Test that verifies that a client created with another encryption backend uses it
+    for its keys and messages instead of `Encryption`.
+
+    Args:
+        mock_socket (mock. Mock): The mock of the socket used in the tests.
+        null_backend (NullEncryption): The backend that does no cryptography.
+    """
+    mock_socket.return_value.recv_into.side_effect = fake_recv_into(b'Registered with ID: 7')
+
+    with mock.patch('shared.encryption.Encryption.load_key') as mock_load_key:
+        client = Client(backend=null_backend)
+
+    mock_load_key.assert_not_called()
+    client.register('testuser')
+
+    mock_socket.return_value.sendall.assert_called_once_with(HEADER.pack(len(b'register testuser')) + b'register testuser')
+    assert client.client_id == 'Registered with ID: 7'
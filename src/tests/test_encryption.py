@@ -1,9 +1,23 @@
 import pytest
 import os
+import sys
+import subprocess
+import warnings
 from unittest import mock
 from Crypto.PublicKey import RSA
 from io import BytesIO
-from shared.encryption import Encryption
+from shared.encryption import Encryption, _read_key
+
+@pytest.fixture(autouse=True)
+def clear_key_cache():
+    """
+    Fixture that empties the cache of loaded keys around each test, so a key loaded
+    from a mocked file is not returned to another test.
+    """
+    _read_key.cache_clear()
+    yield
+    _read_key.cache_clear()
+
 
 def test_generate_keys():
     """
@@ -13,76 +27,102 @@ def test_generate_keys():
     a private key and a public key. It also verifies that the public key correctly matches the
     private key.
     """
-    private_key, public_key = Encryption.generate_keys()
+    private_key, public_key = Encryption.generate_keys(1024)
 
     assert isinstance(private_key, RSA.RsaKey)
     assert isinstance(public_key, RSA.RsaKey)
+    assert private_key.size_in_bits() == 1024
 
     assert private_key.publickey() == public_key
 
 
-@mock.patch('builtins.open', new_callable=mock.mock_open)
-def test_save_key(mock_open):
+@mock.patch('os.close')
+@mock.patch('os.fchmod')
+@mock.patch('os.write', side_effect=lambda fd, data: len(data))
+@mock.patch('os.open', return_value=3)
+def test_save_key(mock_open, mock_write, mock_fchmod, mock_close, rsa_keypair):
     """
     Test to verify saving a public key to a file.
 
     This test simulates saving a public key to a file using the `save_key` method
-    of the `Encryption` class. It verifies that the file is saved to the correct path and in binary write mode.
+    of the `Encryption` class. It verifies that the file is saved to the correct path, opened for writing,
+    and that the whole key is written.
 
     Args:
-        mock_open (mock. Mock): Mock to simulate the `open` function.
+        mock_open (mock. Mock): Mock to simulate the `os.open` function.
+        mock_write (mock. Mock): Mock to simulate the `os.write` function.
+        mock_fchmod (mock. Mock): Mock to simulate the `os.fchmod` function.
+        mock_close (mock. Mock): Mock to simulate the `os.close` function.
+        rsa_keypair (tuple): Session key pair provided by the fixture.
     """
-    private_key, public_key = Encryption.generate_keys()
+    private_key, public_key = rsa_keypair
 
     expected_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server', 'keys', 'server_public_key.pem'))
 
     Encryption.save_key(public_key, 'server_public_key.pem')
 
-    mock_open.assert_called_once_with(expected_path, 'wb')
+    mock_open.assert_called_once_with(expected_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    assert b''.join(bytes(call.args[1]) for call in mock_write.call_args_list) == public_key.export_key(format='DER')
+    mock_close.assert_called_once_with(3)
 
 
-def test_load_existing_key():
+def test_load_existing_key(tmp_path, monkeypatch, rsa_keypair):
     """
     Test to verify loading of a public key from an existing file.
 
-    This test simulates that a public key already exists in a file and verifies that the `load_key` method of the `Encryption` class loads it correctly.
+    This test writes a public key to a file in a temporary keys folder and verifies that the `load_key` method of the `Encryption` class loads it correctly.
+
+    Args:
+        tmp_path (pathlib.Path): Temporary directory used as the keys folder.
+        monkeypatch (pytest.MonkeyPatch): Fixture used to point the keys folder to tmp_path.
+        rsa_keypair (tuple): Session key pair provided by the fixture.
     """
-    fake_key = RSA.generate(2048).publickey()
+    monkeypatch.setattr('shared.encryption._KEYS_DIR', str(tmp_path))
+    fake_key = rsa_keypair[1]
+    (tmp_path / "server_public_key.pem").write_bytes(fake_key.export_key())
 
-    with mock.patch("os.path.exists", return_value=True):
-        with mock.patch("builtins.open", mock.mock_open(read_data=fake_key.export_key())):
-            key = Encryption.load_key("server_public_key.pem")
-            assert key == fake_key  
+    key = Encryption.load_key("server_public_key.pem")
+    assert key == fake_key  
 
 
 @mock.patch('os.path.exists', return_value=False)
 @mock.patch('shared.encryption.Encryption.save_key')
-def test_load_key_generate_new_keys(mock_save_key, mock_exists):
+def test_load_key_generate_new_keys(mock_save_key, mock_exists, rsa_keypair):
     """
     Test to verify that new keys are generated if a public key does not exist.
 
     This test simulates that a file with the public key does not exist, so new keys must be generated.
-    It verifies that the `save_key` function is called and that the new generated key is not `None`.
+    It verifies that the `save_key` function is called and that the new generated public key is returned
+    without reading the file back.
 
     Args:
         mock_save_key (mock. Mock): Mock to simulate the `save_key` function.
         mock_exists (mock. Mock): Mock to simulate that the file does not exist.
+        rsa_keypair (tuple): Session key pair returned as the newly generated keys.
     """
-    key = Encryption.load_key('server_public_key.pem')
+    with mock.patch('shared.encryption.Encryption.generate_keys', return_value=rsa_keypair) as mock_generate_keys:
+        key = Encryption.load_key('server_public_key.pem')
+
+    mock_generate_keys.assert_called_once_with()
 
     mock_save_key.assert_called()
     assert key is not None
+    assert not key.has_private()
+    assert mock_save_key.call_args_list[1].args[0] is key
 
 
-def test_encrypt_message():
+def test_encrypt_message(rsa_keypair):
     """
     Test to verify the encryption of a message.
 
     This test ensures that the `encrypt_message` method correctly encrypts a message using
     the public key. It then verifies that the encrypted message is not identical to the original and that
     it can be correctly decrypted with the private key.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
     """
-    private_key, public_key = Encryption.generate_keys()
+    private_key, public_key = rsa_keypair
     message = "Test message"
     encrypted_message = Encryption.encrypt_message(public_key, message)
 
@@ -92,14 +132,17 @@ def test_encrypt_message():
     assert decrypted_message == message
 
 
-def test_decrypt_message():
+def test_decrypt_message(rsa_keypair):
     """
     Test to verify the decryption of a message.
 
     This test ensures that the `decrypt_message` method correctly decrypts a message
     previously encrypted with the public key.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
     """
-    private_key, public_key = Encryption.generate_keys()
+    private_key, public_key = rsa_keypair
     message = "Another test message"
     encrypted_message = Encryption.encrypt_message(public_key, message)
     decrypted_message = Encryption.decrypt_message(private_key, encrypted_message)
@@ -107,15 +150,19 @@ def test_decrypt_message():
     assert decrypted_message == message
 
 
-def test_decrypt_with_incorrect_key():
+def test_decrypt_with_incorrect_key(rsa_keypair, rsa_other_keypair):
     """
     Test para verificar el error al intentar desencriptar con una clave incorrecta.
     
     Este test asegura que el método `decrypt_message` genere un error si se intenta desencriptar
     un mensaje con una clave privada incorrecta.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+        rsa_other_keypair (tuple): Second session key pair provided by the fixture.
     """
-    private_key1, public_key1 = Encryption.generate_keys()
-    private_key2, _ = Encryption.generate_keys() 
+    private_key1, public_key1 = rsa_keypair
+    private_key2, _ = rsa_other_keypair
 
     message = "Sensitive data"
     encrypted_message = Encryption.encrypt_message(public_key1, message)
@@ -124,14 +171,17 @@ def test_decrypt_with_incorrect_key():
         decrypted_message = Encryption.decrypt_message(private_key2, encrypted_message)
 
 
-def test_sensitive_data_encryption():
+def test_sensitive_data_encryption(rsa_keypair):
     """
     Test to verify that sensitive data can be correctly encrypted and decrypted.
 
     This test ensures that the `encrypt_message` method can encrypt sensitive data, and that
     that data can be correctly decrypted with the corresponding private key.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
     """
-    private_key, public_key = Encryption.generate_keys()
+    private_key, public_key = rsa_keypair
 
     assert isinstance(private_key, RSA.RsaKey), "La clave privada no es del tipo RSA"
     assert isinstance(public_key, RSA.RsaKey), "La clave pública no es del tipo RSA"
@@ -146,15 +196,18 @@ def test_sensitive_data_encryption():
     assert decrypted_data == sensitive_data
 
 
-def test_encrypted_transaction_storage():
+def test_encrypted_transaction_storage(rsa_keypair):
     """
     Test to verify storage of an encrypted transaction.
 
     This test ensures that an encrypted transaction can be stored in a file, simulating
     the encryption of a transaction and verifying that it has been correctly saved to the file.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
     """
     transaction_data = "user1 buy SHSA"
-    fake_public_key = RSA.generate(2048).publickey()
+    fake_public_key = rsa_keypair[1]
     
     encrypted_transaction = Encryption.encrypt_message(fake_public_key, transaction_data)
     
@@ -167,13 +220,16 @@ def test_encrypted_transaction_storage():
         mock_file.return_value.write.assert_called_with(encrypted_transaction)
 
 
-def test_private_key_not_shared():
+def test_private_key_not_shared(rsa_keypair):
     """
     Test to verify that the private key should not be shared or stored.
 
     This test ensures that the private key is never shared or stored in a file in an insecure manner.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
     """
-    private_key, _ = Encryption.generate_keys()
+    private_key, _ = rsa_keypair
     
     with mock.patch("builtins.open", mock.mock_open()) as mock_file:
         with open("server_private_key.pem", 'wb') as file:
@@ -181,7 +237,8 @@ def test_private_key_not_shared():
         
         mock_file.return_value.write.assert_called_once_with(private_key.export_key())
 
-def test_public_key_accessible():
+
+def test_public_key_accessible(rsa_keypair):
     """
     Test to verify that the public key is accessible and can be saved correctly.
 
@@ -190,11 +247,333 @@ def test_public_key_accessible():
 
     It uses the `mock_open` mock to intercept the write operation to the file and ensures that
     `write` is called with the correct contents.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
     """
-    _, public_key = Encryption.generate_keys()
+    _, public_key = rsa_keypair
     
     with mock.patch("builtins.open", mock.mock_open()) as mock_file:
         with open("server_public_key.pem", 'wb') as file:
             file.write(public_key.export_key())
         
-        mock_file.return_value.write.assert_called_once_with(public_key.export_key())
\ No newline at end of file
+        mock_file.return_value.write.assert_called_once_with(public_key.export_key())
+
+
+def test_cipher_cached_per_key(rsa_keypair):
+    """
+    Test to verify that the OAEP cipher of a key is created once and reused.
+
+    This test ensures that `get_cipher` returns the same cipher for the same key and a different
+    cipher for another key, and that messages still round-trip with the cached ciphers.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+    """
+    private_key, public_key = rsa_keypair
+
+    assert Encryption.get_cipher(private_key) is Encryption.get_cipher(private_key)
+    assert Encryption.get_cipher(public_key) is not Encryption.get_cipher(private_key)
+
+    for message in ("First message", "Second message"):
+        encrypted_message = Encryption.encrypt_message(public_key, message)
+        assert Encryption.decrypt_message(private_key, encrypted_message) == message
+
+
+def test_encrypt_long_message(rsa_keypair):
+    """
+    Test to verify that messages longer than what RSA-OAEP can encrypt directly are
+    encrypted and decrypted correctly.
+
+    This test ensures that the hybrid encryption is not limited by the size of the RSA key.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+    """
+    private_key, public_key = rsa_keypair
+    message = "add Shaskitto buy AAPL " * 100
+
+    encrypted_message = Encryption.encrypt_message(public_key, message)
+
+    assert Encryption.decrypt_message(private_key, encrypted_message) == message
+
+
+def test_decrypt_altered_message(rsa_keypair):
+    """
+    Test to verify that decrypting an altered message raises an error.
+
+    This test ensures that the authentication tag of the encrypted message is checked,
+    so a modified ciphertext is rejected instead of decrypting to a different message.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+    """
+    private_key, public_key = rsa_keypair
+    encrypted_message = bytearray(Encryption.encrypt_message(public_key, "Sensitive data"))
+    encrypted_message[-1] ^= 1
+
+    with pytest.raises(ValueError):
+        Encryption.decrypt_message(private_key, bytes(encrypted_message))
+
+
+def test_load_key_converts_pem_key(tmp_path, monkeypatch, rsa_keypair):
+    """
+    Test to verify that a key saved in PEM format by older versions is still loaded,
+    and that it is saved again in DER format under the requested name.
+
+    Args:
+        tmp_path (pathlib.Path): Temporary directory used as the keys folder.
+        monkeypatch (pytest.MonkeyPatch): Fixture used to point the keys folder to tmp_path.
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+    """
+    monkeypatch.setattr('shared.encryption._KEYS_DIR', str(tmp_path))
+    private_key, _ = rsa_keypair
+    (tmp_path / 'server_private_key.pem').write_bytes(private_key.export_key())
+
+    key = Encryption.load_key('server_private_key.der')
+
+    assert key == private_key
+    assert (tmp_path / 'server_private_key.der').read_bytes() == private_key.export_key(format='DER')
+    assert Encryption.load_key('server_private_key.der') == private_key
+
+
+def test_import_does_not_load_crypto():
+    """
+    Test to verify that importing the encryption module does not load the Crypto package,
+    which is only imported when keys or messages are actually used.
+    """
+    src_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    code = "import sys, shared.encryption; sys.exit(any(name.startswith('Crypto') for name in sys.modules))"
+
+    assert subprocess.run([sys.executable, '-c', code], cwd=src_dir).returncode == 0
+
+
+def test_load_key_cached(tmp_path, monkeypatch, rsa_keypair, rsa_other_keypair):
+    """
+    Test to verify that a key file is parsed once and that saving a key replaces
+    the cached one.
+
+    Args:
+        tmp_path (pathlib.Path): Temporary directory used as the keys folder.
+        monkeypatch (pytest.MonkeyPatch): Fixture used to point the keys folder to tmp_path.
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+        rsa_other_keypair (tuple): Second session key pair provided by the fixture.
+    """
+    monkeypatch.setattr('shared.encryption._KEYS_DIR', str(tmp_path))
+    Encryption.save_key(rsa_keypair[0], 'server_private_key.der')
+
+    key = Encryption.load_key('server_private_key.der')
+    assert Encryption.load_key('server_private_key.der') is key
+
+    Encryption.save_key(rsa_other_keypair[0], 'server_private_key.der')
+    assert Encryption.load_key('server_private_key.der') == rsa_other_keypair[0]
+
+
+def test_generate_private_key():
+    """
+    Test to verify that `generate_private_key` returns a private key of the requested size
+    with the public exponent 65537.
+    """
+    private_key = Encryption.generate_private_key(1024)
+
+    assert private_key.has_private()
+    assert private_key.size_in_bits() == 1024
+    assert private_key.e == 65537
+
+
+def test_save_private_key_owner_only(tmp_path, monkeypatch, rsa_keypair):
+    """
+    Test to verify that a private key file is only readable and writable by its owner,
+    while a public key file stays readable by everyone.
+
+    Args:
+        tmp_path (pathlib.Path): Temporary directory used as the keys folder.
+        monkeypatch (pytest.MonkeyPatch): Fixture used to point the keys folder to tmp_path.
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+    """
+    monkeypatch.setattr('shared.encryption._KEYS_DIR', str(tmp_path))
+    private_key, public_key = rsa_keypair
+
+    Encryption.save_key(private_key, 'server_private_key.der')
+    Encryption.save_key(public_key, 'server_public_key.der')
+
+    assert (tmp_path / 'server_private_key.der').stat().st_mode & 0o777 == 0o600
+    assert (tmp_path / 'server_public_key.der').stat().st_mode & 0o777 == 0o644
+    assert Encryption.load_key('server_private_key.der') == private_key
+
+
+@pytest.mark.parametrize('name', ['pycryptodome', 'openssl'])
+def test_crypto_providers_interoperate(name, monkeypatch, rsa_keypair, rsa_other_keypair):
+    """
+    Test to verify that messages encrypted with each crypto provider are decrypted by the
+    PyCryptodome provider and the other way around, and that the provider reports wrong keys
+    and altered messages with `ValueError`. The OpenSSL provider is skipped if 'cryptography'
+    is not installed.
+
+    Args:
+        name (str): The name of the provider under test.
+        monkeypatch (pytest.MonkeyPatch): Fixture used to select the provider.
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+        rsa_other_keypair (tuple): Second session key pair provided by the fixture.
+    """
+    from shared import _crypto_providers
+
+    if name == 'openssl':
+        pytest.importorskip('cryptography')
+    private_key, public_key = rsa_keypair
+    provider = _crypto_providers.PROVIDERS[name]()
+    reference = _crypto_providers.PyCryptodomeProvider()
+
+    monkeypatch.setattr(_crypto_providers, '_provider', provider)
+    encrypted_message = Encryption.encrypt_message(public_key, "Sensitive data")
+    with pytest.raises(ValueError):
+        Encryption.decrypt_message(rsa_other_keypair[0], encrypted_message)
+    with pytest.raises(ValueError):
+        Encryption.decrypt_message(private_key, encrypted_message[:-1] + bytes([encrypted_message[-1] ^ 1]))
+
+    monkeypatch.setattr(_crypto_providers, '_provider', reference)
+    assert Encryption.decrypt_message(private_key, encrypted_message) == "Sensitive data"
+    encrypted_message = Encryption.encrypt_message(public_key, "Sensitive data")
+
+    monkeypatch.setattr(_crypto_providers, '_provider', provider)
+    assert Encryption.decrypt_message(private_key, encrypted_message) == "Sensitive data"
+
+
+def test_encrypt_bytes_message(rsa_keypair):
+    """
+    Test to verify that messages can be encrypted from bytes and decrypted to bytes,
+    without going through strings.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+    """
+    private_key, public_key = rsa_keypair
+    message = "add Shaskitto buy AAPL".encode()
+
+    encrypted_message = Encryption.encrypt_message(public_key, message)
+
+    assert Encryption.decrypt_message(private_key, encrypted_message, return_bytes=True) == message
+    assert Encryption.decrypt_message(private_key, encrypted_message) == message.decode()
+
+
+def test_encrypt_messages_batch(rsa_keypair):
+    """
+    Test to verify that a batch of messages is encrypted with a single RSA operation,
+    and that each encrypted message can be decrypted on its own or as part of a batch.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+    """
+    private_key, public_key = rsa_keypair
+    messages = ["Transaction added", "No transactions found.", b"Unknown command"]
+
+    encrypted_messages = Encryption.encrypt_messages(public_key, messages)
+
+    assert len({encrypted_message[:private_key.size_in_bytes()] for encrypted_message in encrypted_messages}) == 1
+    assert len(set(encrypted_messages)) == len(messages)
+    assert Encryption.decrypt_message(private_key, encrypted_messages[0]) == "Transaction added"
+    assert Encryption.decrypt_messages(private_key, encrypted_messages) == ["Transaction added", "No transactions found.", "Unknown command"]
+    assert Encryption.decrypt_messages(private_key, encrypted_messages[2:], return_bytes=True) == [b"Unknown command"]
+
+
+def _cpuinfo_has(feature):
+    """
+    Checks whether the processor reports a feature flag in '/proc/cpuinfo'.
+
+    Args:
+        feature (str): The flag to look for, such as 'aes'.
+
+    Returns:
+        bool: True if the flag is reported, False otherwise or if '/proc/cpuinfo' cannot be read.
+    """
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('flags'):
+                    return feature in line.split(':', 1)[1].split()
+    except OSError:
+        pass
+    return False
+
+
+@pytest.mark.skipif(not _cpuinfo_has('aes'), reason="needs AES-NI")
+def test_pycryptodome_uses_aes_ni():
+    """
+    Test to verify that the installed PyCryptodome runs AES with the AES-NI instructions
+    on a processor that has them, so it is not a build without assembly, and that its
+    provider is created without warnings.
+    """
+    from Crypto.Util._cpu_features import have_aes_ni
+    from shared._crypto_providers import PyCryptodomeProvider
+
+    assert have_aes_ni()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        PyCryptodomeProvider()
+
+
+def test_pycryptodome_warns_without_aes_ni():
+    """
+    Test to verify that a warning is issued when PyCryptodome cannot use AES-NI.
+    """
+    from shared._crypto_providers import PyCryptodomeProvider
+
+    with mock.patch('Crypto.Util._cpu_features.have_aes_ni', return_value=0):
+        with pytest.warns(RuntimeWarning, match='AES-NI'):
+            PyCryptodomeProvider()
+
+
+def test_oaep_uses_sha256(rsa_keypair):
+    """
+    Test to verify that the session key is encrypted with OAEP using SHA-256, so a cipher
+    built with the SHA-1 defaults cannot decrypt it.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+    """
+    from Crypto.Cipher import PKCS1_OAEP
+    from Crypto.Hash import SHA256
+
+    private_key, public_key = rsa_keypair
+    encrypted_session_key = Encryption.encrypt_message(public_key, "Sensitive data")[:private_key.size_in_bytes()]
+
+    assert len(PKCS1_OAEP.new(private_key, hashAlgo=SHA256).decrypt(encrypted_session_key)) == 32
+    with pytest.raises(ValueError):
+        PKCS1_OAEP.new(private_key).decrypt(encrypted_session_key)
+
+
+def test_session_messages(rsa_keypair):
+    """
+    Test to verify that a session key established with the public key is recovered with
+    the private key, and that messages encrypted with it decrypt correctly and are authenticated.
+
+    Args:
+        rsa_keypair (tuple): Session key pair provided by the fixture.
+    """
+    private_key, public_key = rsa_keypair
+    session_key, encrypted_session_key = Encryption.establish_session(public_key)
+
+    assert len(encrypted_session_key) == private_key.size_in_bytes()
+    assert Encryption.open_session(private_key, encrypted_session_key) == session_key
+
+    encrypted_message = Encryption.encrypt_session_message(session_key, "Sensitive data")
+    assert Encryption.decrypt_session_message(session_key, encrypted_message) == "Sensitive data"
+
+    altered_message = encrypted_message[:-1] + bytes([encrypted_message[-1] ^ 1])
+    with pytest.raises(ValueError):
+        Encryption.decrypt_session_message(session_key, altered_message)
+
+
+def test_session_messages_use_no_rsa():
+    """
+    Test to verify that once a session key is established, messages are encrypted and
+    decrypted without any RSA operation.
+    """
+    from shared._crypto_providers import get_provider
+
+    provider = get_provider()
+    session_key = bytes(32)
+    with mock.patch.object(provider, 'encrypt_oaep', side_effect=AssertionError), \
+         mock.patch.object(provider, 'decrypt_oaep', side_effect=AssertionError):
+        encrypted_message = Encryption.encrypt_session_message(session_key, "Sensitive data")
+        assert Encryption.decrypt_session_message(session_key, encrypted_message) == "Sensitive data"
@@ -0,0 +1,84 @@
+import socket
+import threading
+import pytest
+from shared.framing import Framing, HEADER
+
+@pytest.fixture
+def socket_pair():
+    """
+    Fixture that creates a pair of connected sockets and closes them at the end of the test.
+
+    Returns:
+        tuple: The two connected sockets.
+    """
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+def test_send_and_receive_frame(socket_pair):
+    """
+    Test to verify that a payload sent with `send_frame` is received unchanged by `recv_frame`.
+
+    Args:
+        socket_pair (tuple): Connected sockets provided by the fixture.
+    """
+    left, right = socket_pair
+    Framing.send_frame(left, b'hello')
+
+    assert Framing.recv_frame(right, bytearray(16)) == b'hello'
+
+def test_receive_frame_larger_than_buffer(socket_pair):
+    """
+    Test to verify that a payload larger than the receive buffer (and than the old 1024-byte
+    receive size) arrives whole, growing the buffer as needed.
+
+    Args:
+        socket_pair (tuple): Connected sockets provided by the fixture.
+    """
+    left, right = socket_pair
+    payload = bytes(range(256)) * 1024
+    sender = threading.Thread(target=Framing.send_frame, args=(left, payload))
+    sender.start()
+
+    buffer = bytearray(1024)
+    assert Framing.recv_frame(right, buffer) == payload
+    assert len(buffer) >= len(payload)
+    sender.join()
+
+def test_receive_frame_on_closed_connection(socket_pair):
+    """
+    Test to verify that a cleanly closed connection returns None, and that a connection
+    closed in the middle of a message raises an error.
+
+    Args:
+        socket_pair (tuple): Connected sockets provided by the fixture.
+    """
+    left, right = socket_pair
+    left.sendall(HEADER.pack(10) + b'short')
+    left.close()
+
+    with pytest.raises(ConnectionError):
+        Framing.recv_frame(right, bytearray(16))
+
+    assert Framing.recv_frame(right, bytearray(16)) is None
+
+def test_send_large_frame_with_partial_writes():
+    """
+    Test to verify that large payloads sent with scatter-gather I/O are resent correctly
+    when the socket only accepts part of the data on each call.
+    """
+    class PartialSocket:
+        def __init__(self):
+            self.sent = bytearray()
+
+        def sendmsg(self, buffers):
+            accepted = bytes(b''.join(buffers))[:1000]
+            self.sent.extend(accepted)
+            return len(accepted)
+
+    sock = PartialSocket()
+    payload = bytes(range(256)) * 64
+    Framing.send_frame(sock, payload)
+
+    assert bytes(sock.sent) == HEADER.pack(len(payload)) + payload
@@ -1,83 +1,344 @@
 import socket
+import asyncio
+import functools
+import threading
+import json
 import pytest
-import random
-import string
+import os
+import base64
+import shutil
 from shared.encryption import Encryption
+from shared.framing import Framing, HEADER, MAX_FRAME_SIZE
+from server.server import Server
 
-SERVER_HOST = 'localhost'
-SERVER_PORT = 5000
-PUBLIC_KEY_PATH = 'server_public_key.pem'
-PRIVATE_KEY_PATH = 'server_private_key.pem'
+PUBLIC_KEY_PATH = 'server_public_key.der'
+PRIVATE_KEY_PATH = 'server_private_key.der'
+SERVER_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server')
+_RECEIVE_BUFFER = bytearray(1024)
+RESPONSE_TIMEOUT = 5.0
 
-def connect_to_server():
+@pytest.fixture(scope="session")
+def keys():
     """
-    Establishes a connection to the server and loads the public and private keys needed for encryption.
+    Fixture that loads the public and private keys needed for encryption once for the whole session.
 
-    This function creates a client socket that connects to the server at the addresses defined by
-    SERVER_HOST and SERVER_PORT. It then loads the public and private keys needed for
-    encryption and decryption operations.
+    Returns:
+        tuple: The loaded public key and private key.
+    """
+    return Encryption.load_key(PUBLIC_KEY_PATH), Encryption.load_key(PRIVATE_KEY_PATH)
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    """
+    Fixture that starts the server under test in the test process with 'ServerThread', on a
+    free port it never connects to: the tests connect to it with 'ServerThread.connect'
+    instead of over TCP. The server works on a temporary copy of the blockchain and the users in
+    SERVER_DATA_DIR, so the tests leave the data of the repository untouched.
+    The server is stopped at the end of the session, which mines the pending transactions
+    and closes the chain log, and the server socket is closed.
+
+    Args:
+        tmp_path_factory (pytest.TempPathFactory): Fixture used to create the folder of the copy.
+
+    Yields:
+        ServerThread: The running server under test.
+    """
+    data_dir = tmp_path_factory.mktemp('server_data')
+    shutil.copytree(os.path.join(SERVER_DATA_DIR, 'blockchain_data'), data_dir / 'blockchain_data')
+    shutil.copytree(os.path.join(SERVER_DATA_DIR, 'users_data'), data_dir / 'users_data')
+    server = Server(port=0, blockchain_dir=str(data_dir / 'blockchain_data'),
+                    users_file=str(data_dir / 'users_data' / 'users.json'))
+    running = ServerThread(server)
+    yield running
+    running.stop()
+    server.server_socket.close()
+
+class ServerThread:
+    """
+    Runs 'Server.serve' on an event loop in a daemon thread, so the tests go through the
+    same asyncio path, worker pool and proof-of-work process as a started server. Connections
+    are pairs of connected Unix sockets, whose server end is handed to 'Server.handle_connection'
+    on the loop: there is no TCP handshake and the messages do not go through the TCP/IP stack.
+
+    Attributes:
+        server (Server): The server under test.
+        loop (asyncio.AbstractEventLoop): The event loop running the server.
+    """
+
+    def __init__(self, server):
+        """
+        Starts the event loop thread and the server on it.
+
+        Args:
+            server (Server): The server under test.
+        """
+        self.server = server
+        self.loop = asyncio.new_event_loop()
+        self._connections = set()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        self._serving = asyncio.run_coroutine_threadsafe(self._start_serving(), self.loop).result()
+
+    async def _start_serving(self):
+        """
+        Creates the task serving the server.
+
+        Returns:
+            asyncio.Task: The task running 'Server.serve'.
+        """
+        return asyncio.create_task(self.server.serve())
+
+    async def _serve_socket(self, server_socket):
+        """
+        Serves one connection with 'Server.handle_connection'.
+
+        Args:
+            server_socket (socket.socket): The server end of the connection.
+        """
+        reader, writer = await asyncio.open_connection(sock=server_socket)
+        await self.server.handle_connection(reader, writer)
+
+    def connect(self):
+        """
+        Opens a connection to the server. Receiving on the client end times out after
+        RESPONSE_TIMEOUT seconds, so a server that stops answering fails the test instead
+        of hanging the whole run.
+
+        Returns:
+            socket.socket: The client end of the connection.
+        """
+        client_socket, server_socket = socket.socketpair()
+        client_socket.settimeout(RESPONSE_TIMEOUT)
+        # The event loop only keeps weak references to its tasks: keep the connection
+        # futures, so a connection waiting for data is not garbage-collected.
+        connection = asyncio.run_coroutine_threadsafe(self._serve_socket(server_socket), self.loop)
+        self._connections.add(connection)
+        connection.add_done_callback(self._connections.discard)
+        return client_socket
+
+    async def _shutdown(self):
+        """
+        Stops the server and the connections still being served.
+        """
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        """
+        Stops the server, which mines the pending transactions and closes the chain log,
+        and then the event loop thread.
+        """
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+class SharedConnection:
+    """
+    Connection to the server shared by the tests. A session key is sent to the server encrypted
+    with its public key as soon as the socket connects, so the commands of the tests are
+    encrypted with AES-GCM alone instead of paying for an RSA operation on each side for every
+    message. If a test closes the socket, for instance after a timeout left a response unread,
+    the next test gets a new connection with the same session key.
+
+    Attributes:
+        server (ServerThread): The running server under test.
+        session_key (bytes): The session key of the connection.
+        encrypted_session_key (bytes): The session key encrypted with the server public key.
+        socket (socket.socket or None): The client socket, or None before the first connection.
+    """
+
+    def __init__(self, server, public_key):
+        """
+        Creates the session key without connecting yet.
+
+        Args:
+            server (ServerThread): The running server under test.
+            public_key (RSA.RsaKey): The public key to encrypt the session key.
+        """
+        self.server = server
+        self.session_key, self.encrypted_session_key = Encryption.establish_session(public_key)
+        self.socket = None
+
+    def get(self):
+        """
+        Returns the open connection, connecting and opening the session first if needed.
+
+        Returns:
+            tuple: A connected socket client and the session key of the connection.
+        """
+        if self.socket is None or self.socket.fileno() == -1:
+            self.socket = self.server.connect()
+            response = send_encrypted_and_receive(self.socket, self.session_key, self.encrypted_session_key)
+            assert response == "Session established"
+        return self.socket, self.session_key
+
+    def close(self):
+        """
+        Closes the socket, if it is open.
+        """
+        if self.socket is not None:
+            self.socket.close()
+
+@pytest.fixture(scope="session")
+def shared_connection(server, keys):
+    """
+    Fixture that creates the connection to the server shared by every test of the session,
+    so the tests do not pay for a new connection each time. The server processes any number
+    of commands on the same connection. The socket is closed at the end of the session.
+
+    Args:
+        server (ServerThread): The running server under test provided by the 'server' fixture.
+        keys (tuple): The public key and private key loaded by the 'keys' fixture.
+
+    Yields:
+        SharedConnection: The shared connection.
+    """
+    connection = SharedConnection(server, keys[0])
+    yield connection
+    connection.close()
+
+@pytest.fixture
+def conn(shared_connection):
+    """
+    Fixture that provides the shared connection to a test, reopened if a previous test closed it.
+
+    Args:
+        shared_connection (SharedConnection): The connection provided by the 'shared_connection' fixture.
+
+    Returns:
+        tuple: A connected socket client and the session key of the connection.
+    """
+    return shared_connection.get()
+
+FIXED_COMMANDS = ("register Shaskitto", "add Shaskitto buy AAPL", "copy Shaskitto", "verify", "unknown_command")
+READ_ONLY_COMMANDS = ("register Shaskitto", "verify", "unknown_command")
+
+@pytest.fixture(scope="session")
+def encrypted_commands(shared_connection):
+    """
+    Fixture that encrypts the fixed commands sent by the tests once for the whole session,
+    so the tests that send them, or send them again, do not encrypt them each time.
+
+    Args:
+        shared_connection (SharedConnection): The connection provided by the 'shared_connection' fixture.
 
     Returns:
-        tuple: A connected socket client, loaded public key, and loaded private key.
+        dict: The encrypted version of each command in FIXED_COMMANDS.
     """
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect((SERVER_HOST, SERVER_PORT))
-    public_key = Encryption.load_key(PUBLIC_KEY_PATH)
-    private_key = Encryption.load_key(PRIVATE_KEY_PATH)
-    return client_socket, public_key, private_key
+    session_key = shared_connection.session_key
+    return {command: Encryption.encrypt_session_message(session_key, command) for command in FIXED_COMMANDS}
 
-def send_and_receive(socket, public_key, private_key, message):
+def send_and_receive(client_socket, session_key, message):
     """
     Sends an encrypted message to the server and receives the decrypted response.
 
-    This function encrypts the message using the public key, sends it to the server over the socket,
-    and then receives the response, which is decrypted using the private key.
+    This function encrypts the message using the session key, sends it to the server over the socket
+    as a length-prefixed message, and then receives the response, which is decrypted using the session key.
+    The response is received into a buffer shared by all the calls, instead of a new one each time.
 
     Args:
-        socket (socket.socket): The client socket connected to the server.
-        public_key (RSA.RsaKey): The public key to encrypt the message.
-        private_key (RSA.RsaKey): The private key to decrypt the response.
+        client_socket (socket.socket): The client socket connected to the server.
+        session_key (bytes): The session key of the connection.
         message (str): The message to be sent to the server.
 
     Returns:
         str: The decrypted response from the server.
     """
-    encrypted_message = Encryption.encrypt_message(public_key, message)
-    socket.send(encrypted_message)
-    encrypted_response = socket.recv(1024)
-    return Encryption.decrypt_message(private_key, encrypted_response)
+    encrypted_message = Encryption.encrypt_session_message(session_key, message)
+    return send_encrypted_and_receive(client_socket, session_key, encrypted_message)
 
-def test_register_existing_user():
+def send_encrypted_and_receive(client_socket, session_key, encrypted_message):
     """
-    Verifies that the server responds correctly when attempting to register an existing username.
+    Sends an already encrypted message to the server and receives the decrypted response.
+    If no response arrives within RESPONSE_TIMEOUT seconds, the socket is closed, so a late
+    response is never read by a later test, and the test fails.
 
-    This test simulates an attempt to register a user whose username is already taken
-    and ensures that the server responds with the appropriate message.
+    Args:
+        client_socket (socket.socket): The client socket connected to the server.
+        session_key (bytes): The session key of the connection.
+        encrypted_message (bytes): The message to be sent, already encrypted.
 
-    Asserts:
-        'Username already taken' - Expected response from the server when the user already exists.
+    Returns:
+        str: The decrypted response from the server.
     """
-    client_socket, public_key, private_key = connect_to_server()
+    Framing.send_frame(client_socket, encrypted_message)
     try:
-        response = send_and_receive(client_socket, public_key, private_key, "register Shaskitto")
-        assert response == "Username already taken", f"Expected 'Username already taken', got '{response}'"
-    finally:
+        encrypted_response = Framing.recv_frame(client_socket, _RECEIVE_BUFFER)
+    except socket.timeout:
         client_socket.close()
+        pytest.fail(f"The server did not respond within {RESPONSE_TIMEOUT} seconds")
+    return Encryption.decrypt_session_message(session_key, encrypted_response)
+
+@functools.lru_cache(maxsize=64)
+def read_only_response(client_socket, session_key, encrypted_command):
+    """
+    Sends an already encrypted command that does not change the server state and returns the
+    decrypted response. The response is remembered, so asking again for the response to the
+    same command on the same connection does not send it again.
+
+    Only commands in READ_ONLY_COMMANDS may be sent with this function: for them the response
+    stays the same while the tests run.
+
+    Args:
+        client_socket (socket.socket): The client socket connected to the server.
+        session_key (bytes): The session key of the connection.
+        encrypted_command (bytes): The command to be sent, already encrypted.
+
+    Returns:
+        str: The decrypted response from the server.
+    """
+    return send_encrypted_and_receive(client_socket, session_key, encrypted_command)
+
+async def send_and_receive_async(server, public_key, message):
+    """
+    Opens a connection to the server with asyncio, opens a session on it, sends an encrypted
+    message and receives the decrypted response.
+
+    While this coroutine waits for the server, the event loop runs the others, so several
+    requests share one thread and their waits overlap.
+
+    Args:
+        server (ServerThread): The running server under test.
+        public_key (RSA.RsaKey): The public key to encrypt the session key.
+        message (str): The message to be sent to the server.
+
+    Returns:
+        str: The decrypted response from the server.
+    """
+    async def exchange(payload):
+        writer.write(HEADER.pack(len(payload)) + payload)
+        await writer.drain()
+        (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+        return Encryption.decrypt_session_message(session_key, await reader.readexactly(length))
+
+    reader, writer = await asyncio.open_connection(sock=server.connect())
+    try:
+        session_key, encrypted_session_key = Encryption.establish_session(public_key)
+        await exchange(encrypted_session_key)
+        return await exchange(Encryption.encrypt_session_message(session_key, message))
+    finally:
+        writer.close()
+        await writer.wait_closed()
 
 def generate_random_username():
     """
     Generates a random 8-character alphanumeric username.
 
-    Uses alphabetic and numeric characters to generate a random string
-    of length 8, which is useful for tests that require unique usernames.
+    Uses lowercase letters and digits to generate a random string of length 8, which is
+    useful for tests that require unique usernames. The 40 random bits are read with a single
+    'os.urandom' call and encoded in base 32 in C, so every character is equally likely.
 
     Returns:
         str: A random 8-character username.
     """
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=8))
+    return base64.b32encode(os.urandom(5)).decode('ascii').lower()
 
 
-def test_register_new_user():
+@pytest.mark.xdist_group("server_state")
+def test_register_new_user(conn):
     """
     Verifies that the server successfully registers a new user.
 
@@ -87,17 +348,18 @@ def test_register_new_user():
 
     Asserts:
         'Registered with ID' - Expected response indicating that the registration was successful.
+
+    Args:
+        conn (tuple): The connected socket and session key provided by the fixture.
     """
-    client_socket, public_key, private_key = connect_to_server()
-    try:
-        username = generate_random_username() 
-        response = send_and_receive(client_socket, public_key, private_key, f"register {username}")
-        assert "Registered with ID" in response, f"Expected registration response, got '{response}'"
-    finally:
-        client_socket.close()
+    client_socket, session_key = conn
+    username = generate_random_username() 
+    response = send_and_receive(client_socket, session_key, f"register {username}")
+    assert "Registered with ID" in response
 
 
-def test_add_transaction_existing_user():
+@pytest.mark.xdist_group("server_state")
+def test_add_transaction_existing_user(conn, encrypted_commands):
     """
     Verifies that the server accepts and processes a transaction from an already registered user.
 
@@ -106,62 +368,214 @@ def test_add_transaction_existing_user():
 
     Asserts:
     'Transaction added' - Expected response from the server when processing the transaction.
+
+    Args:
+        conn (tuple): The connected socket and session key provided by the fixture.
+        encrypted_commands (dict): The encrypted fixed commands provided by the fixture.
     """
-    client_socket, public_key, private_key = connect_to_server()
-    try:
-        response = send_and_receive(client_socket, public_key, private_key, "add Shaskitto buy AAPL")
-        assert response == "Transaction added", f"Expected 'Transaction added', got '{response}'"
-    finally:
-        client_socket.close()
+    client_socket, session_key = conn
+    response = send_encrypted_and_receive(client_socket, session_key, encrypted_commands["add Shaskitto buy AAPL"])
+    assert response == "Transaction added"
 
-def test_copy_transactions_user():
+@pytest.mark.parametrize("command, expected, exact", [
+    ("register Shaskitto", "Username already taken", True),
+    ("copy Shaskitto", "Transactions copied for user Shaskitto", False),
+    ("verify", "The blockchain is valid and has not been altered.", True),
+    ("unknown_command", "Unknown command", True),
+], ids=["register_existing_user", "copy_transactions_user", "verify_blockchain", "unknown_command"])
+def test_fixed_command(conn, encrypted_commands, command, expected, exact, tmp_path, monkeypatch):
     """
-    Verifies that the server correctly copies the transactions of a registered user.
+    Verifies the response of the server to each of the fixed commands that the tests send.
 
-    This test simulates the request to copy the transactions of an existing user, in this case 'Shaskitto',
-    and validates that the server responds confirming the action.
+    - 'register Shaskitto': the username is already taken.
+    - 'copy Shaskitto': the transactions of the user are copied to a file, whose path is
+      at the end of the response.
+    - 'verify': the blockchain is valid and has not been altered.
+    - 'unknown_command': the command is not known.
 
     Asserts:
-        'Transactions copied' - Expected response from the server when copying the transactions.
+        The response is the expected one, or starts with it when 'exact' is False.
+
+    Args:
+        conn (tuple): The connected socket and session key provided by the fixture.
+        encrypted_commands (dict): The encrypted fixed commands provided by the fixture.
+        command (str): The command to send.
+        expected (str): The expected response.
+        exact (bool): Whether the whole response must be the expected one.
+        tmp_path (pathlib.Path): Temporary folder where 'copy' writes its file.
+        monkeypatch (pytest.MonkeyPatch): Fixture used to change to tmp_path.
     """
-    client_socket, public_key, private_key = connect_to_server()
-    try:
-        response = send_and_receive(client_socket, public_key, private_key, "copy Shaskitto")
-        assert "Transactions copied" in response, f"Expected success response, got '{response}'"
-    finally:
-        client_socket.close()
+    monkeypatch.chdir(tmp_path)
+    client_socket, session_key = conn
+    if command in READ_ONLY_COMMANDS:
+        response = read_only_response(client_socket, session_key, encrypted_commands[command])
+    else:
+        response = send_encrypted_and_receive(client_socket, session_key, encrypted_commands[command])
+    if exact:
+        assert response == expected
+    else:
+        assert response.startswith(expected)
 
-def test_verify_blockchain():
+def test_read_only_commands_concurrently(server, keys, conn, encrypted_commands):
     """
-    Verifies that the server can validate the integrity of the blockchain.
+    Verifies that the server answers commands that do not change its state when they arrive
+    at the same time on different connections.
 
-    This test requests validation of the blockchain on the server and verifies that the response
-    indicates that the blockchain is valid and has not been altered.
+    The three commands are sent from coroutines gathered on one event loop, so the waits for
+    the server overlap instead of adding up. The server serves the three connections at the
+    same time on its own event loop, with 'Server.handle_connection'.
 
     Asserts:
-        'The blockchain is valid and has not been altered.' - Expected response when verifying the blockchain.
+        Each command gets the same response it gets when sent on its own through the shared
+        connection (remembered by 'read_only_response').
+
+    Args:
+        server (ServerThread): The running server under test provided by the fixture.
+        keys (tuple): The public key and private key provided by the fixture.
+        conn (tuple): The connected socket and session key provided by the fixture.
+        encrypted_commands (dict): The encrypted fixed commands provided by the fixture.
+    """
+    async def send_all():
+        requests = asyncio.gather(*(send_and_receive_async(server, keys[0], command) for command in commands))
+        return await asyncio.wait_for(requests, RESPONSE_TIMEOUT)
+
+    commands = READ_ONLY_COMMANDS
+    try:
+        responses = asyncio.run(send_all())
+    except asyncio.TimeoutError:
+        pytest.fail(f"The server did not respond within {RESPONSE_TIMEOUT} seconds")
+    assert responses == [read_only_response(*conn, encrypted_commands[command]) for command in commands]
+
+def test_unanswered_command_closes_connection():
+    """
+    Verifies that a command left without a response fails the test and closes the socket,
+    so the shared connection is reopened instead of reading the late response in another test.
     """
-    client_socket, public_key, private_key = connect_to_server()
+    client_socket, silent_socket = socket.socketpair()
+    client_socket.settimeout(0.01)
     try:
-        response = send_and_receive(client_socket, public_key, private_key, "verify")
-        assert response == "The blockchain is valid and has not been altered.", \
-            f"Expected blockchain validation response, got '{response}'"
+        with pytest.raises(pytest.fail.Exception):
+            send_encrypted_and_receive(client_socket, bytes(32), b'unanswered')
+        assert client_socket.fileno() == -1
     finally:
         client_socket.close()
+        silent_socket.close()
+
+def test_static_responses_encrypted_each_time(unstarted_server):
+    """
+    Verifies that a constant response gets a new ciphertext and encrypted AES key every time.
 
-def test_unknown_command():
+    Args:
+        unstarted_server (Server): The server provided by the fixture.
     """
-    Verifies that the server responds correctly to an unknown command.
+    server = unstarted_server
+    key_size = server.private_key.size_in_bytes()
+    first_response = server.encrypt_response('Unknown command')
+    second_response = server.encrypt_response('Unknown command')
+    assert first_response[:key_size] != second_response[:key_size]
+    assert Encryption.decrypt_messages(server.private_key, [first_response, second_response]) == \
+        ['Unknown command', 'Unknown command']
 
-    This test simulates the sending of a command not recognized by the server and validates that the server
-    responds with the appropriate message indicating that the command is not known.
+def test_session_opened_on_connection(unstarted_server):
+    """
+    Verifies that a message the size of an RSA block opens a session, and that the following
+    commands are answered with the session key.
 
-    Asserts:
-        'Unknown command' - Expected response from the server when receiving an unrecognized command.
+    Args:
+        unstarted_server (Server): The server provided by the fixture.
+    """
+    server = unstarted_server
+    session_key, encrypted_session_key = Encryption.establish_session(server.private_key)
+    opened_key, encrypted_response = server.handle_frame(encrypted_session_key)
+    assert opened_key == session_key
+    assert Encryption.decrypt_session_message(session_key, encrypted_response) == 'Session established'
+
+    encrypted_command = Encryption.encrypt_session_message(session_key, 'unknown_command')
+    opened_key, encrypted_response = server.handle_frame(encrypted_command, opened_key)
+    assert opened_key == session_key
+    assert Encryption.decrypt_session_message(session_key, encrypted_response) == 'Unknown command'
+
+def test_transactions_mined_in_batches(unstarted_server):
+    """
+    Verifies that a block is only mined when 'batch_size' transactions are pending or the
+    mempool is flushed, and never by a command that reads the chain.
+
+    Args:
+        unstarted_server (Server): The server provided by the fixture.
+    """
+    server = unstarted_server
+    server.batch_size = 2
+    server.batch_delay = 60
+    server.users = {'Shaskitto': '1'}
+    chain_length = len(server.blockchain.chain)
+
+    assert server.handle_add_transaction(['Shaskitto', 'buy', 'AAPL']) == 'Transaction added'
+    assert len(server.blockchain.chain) == chain_length
+
+    assert server.handle_add_transaction(['Shaskitto', 'sell', 'MSFT']) == 'Transaction added'
+    assert len(server.blockchain.chain) == chain_length + 1
+    assert [t['stock_name'] for t in server.blockchain.last_block['data']] == ['AAPL', 'MSFT']
+
+    server.handle_add_transaction(['Shaskitto', 'buy', 'GOOG'])
+    assert server.handle_verify_integrity() == 'The blockchain is valid and has not been altered.'
+    assert server.handle_copy_transactions(['copy', 'Nobody']) == 'Username not registered'
+    assert len(server.blockchain.chain) == chain_length + 1
+
+    block = server.flush_mempool()
+    assert block is server.blockchain.last_block
+    assert [t['stock_name'] for t in block['data']] == ['GOOG']
+    assert server.flush_mempool() is None
+    assert server.blockchain.is_valid_chain()
+
+def test_copy_transactions_written_as_json(unstarted_server, tmp_path, monkeypatch):
+    """
+    Verifies that copied transactions are written as a JSON array, and that no file is
+    created when there is nothing to copy.
+
+    Args:
+        unstarted_server (Server): The server provided by the fixture.
+        tmp_path (pathlib.Path): Temporary folder where the file is written.
+        monkeypatch (pytest.MonkeyPatch): Fixture used to change to tmp_path.
+    """
+    monkeypatch.chdir(tmp_path)
+    server = unstarted_server
+    server.batch_size = 1
+    server.users = {'Shaskitto': '101', 'A': '102'}
+    server.handle_add_transaction(['Shaskitto', 'buy', 'AAPL'])
+    server.handle_add_transaction(['Shaskitto', 'sell', 'MSFT'])
+
+    assert server.copy_user_transactions('Shaskitto').startswith('Transactions copied')
+    with open(tmp_path / 'transactions_Shaskitto.json') as file:
+        copied = json.load(file)
+    assert [info['transaction']['stock_name'] for info in copied] == ['AAPL', 'MSFT']
+    assert copied[1]['block_info']['hash'] == server.blockchain.last_block['hash']
+
+    assert server.copy_user_transactions('A') == 'No transactions found for this user.'
+    assert not (tmp_path / 'transactions_A.json').exists()
+
+def test_closed_connection_not_held_by_proof_worker(unstarted_server):
+    """
+    Verifies that a connection the server closes after a block has been mined reaches the
+    client: the proof-of-work process must not hold a copy of the connection open.
+
+    Args:
+        unstarted_server (Server): The server provided by the fixture.
     """
-    client_socket, public_key, private_key = connect_to_server()
+    server = unstarted_server
+    server.batch_size = 1
+    server.users = {'Shaskitto': '1'}
+    running = ServerThread(server)
     try:
-        response = send_and_receive(client_socket, public_key, private_key, "unknown_command")
-        assert response == "Unknown command", f"Expected 'Unknown command', got '{response}'"
+        idle_socket = running.connect()
+        client_socket = running.connect()
+        session_key, encrypted_session_key = Encryption.establish_session(server.private_key.publickey())
+        assert send_encrypted_and_receive(client_socket, session_key, encrypted_session_key) == 'Session established'
+        assert send_and_receive(client_socket, session_key, 'add Shaskitto buy AAPL') == 'Transaction added'
+        assert server.blockchain.last_block['data'][0]['stock_name'] == 'AAPL'
+
+        idle_socket.sendall(HEADER.pack(MAX_FRAME_SIZE + 1))
+        assert idle_socket.recv(1) == b''
+        idle_socket.close()
+        client_socket.close()
     finally:
-        client_socket.close()
\ No newline at end of file
+        running.stop()